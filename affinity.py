@@ -0,0 +1,134 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+
+"""
+CPU placement of the preforked children.
+
+Left alone, the scheduler moves a child to whichever CPU is free and
+the caches it warmed up on the previous one go cold. With --pin every
+child is bound to a single CPU with 'sched_setaffinity', the children
+spread round-robin over the CPUs the server may run on (or over
+--cpus). With --cpus alone all children share that set and the
+scheduler still moves them within it.
+
+With SO_REUSEPORT (server03.py -r) every child has its own listening
+socket. Setting SO_INCOMING_CPU on it to the child's CPU makes the
+kernel prefer that socket for connections whose packets are processed
+on the same CPU, so a connection stays on one core all the way from
+the network interrupt to the response.
+
+The preforked servers start as many children as there are CPUs
+available to them unless told otherwise (--child-num).
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import socket
+
+# missing from the socket module of older Pythons
+SO_INCOMING_CPU = getattr(socket, 'SO_INCOMING_CPU', 49)
+
+
+def available_cpus():
+    """Returns the sorted list of CPUs this process may run on."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def parse_cpus(spec):
+    """Returns the CPUs of a list like '0-3,8,10-11'."""
+    cpus = []
+    for part in spec.split(','):
+        first, sep, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cpus))
+
+
+class Placement(object):
+    """Which CPUs the child in a slot runs on: one of `cpus` if `pin`,
+    all of them otherwise."""
+
+    def __init__(self, cpus, pin=False):
+        self.cpus = cpus
+        self.pin = pin
+
+    def cpus_for(self, index):
+        if self.pin:
+            return {self.cpus[index % len(self.cpus)]}
+        return set(self.cpus)
+
+    def apply(self, index):
+        """Called in the child."""
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cpus_for(index))
+
+    def steer(self, listen_sock, index):
+        """Ask the kernel for the connections processed on the CPU of
+        the child in the slot, if it has one."""
+        if not self.pin:
+            return
+        cpu = self.cpus[index % len(self.cpus)]
+        try:
+            listen_sock.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, cpu)
+        except OSError:
+            # not Linux or older than 3.19
+            pass
+
+
+def add_options(parser):
+    parser.add_option(
+        '--pin', dest='pin', action='store_true', default=False,
+        help=('Pin every child to one CPU, round-robin. '
+              'Default is to let the scheduler move them'))
+
+    parser.add_option(
+        '--cpus', dest='cpus', metavar='LIST',
+        help=('Run the children only on these CPUs, like 0-3,8. '
+              'Default is all CPUs available'))
+
+
+def create_placement(options):
+    """Returns a Placement for the command line options, None if the
+    scheduler places the children. Raises ValueError for a bad --cpus."""
+    if not options.pin and not options.cpus:
+        return None
+    cpus = available_cpus()
+    if options.cpus:
+        try:
+            wanted = parse_cpus(options.cpus)
+        except ValueError:
+            wanted = []
+        if not wanted:
+            raise ValueError('--cpus takes a list like 0-3,8')
+        missing = set(wanted) - set(cpus)
+        if missing:
+            raise ValueError('CPUs not available: %s' % ','.join(
+                str(cpu) for cpu in sorted(missing)))
+        cpus = wanted
+    return Placement(cpus, options.pin)
+
@@ -0,0 +1,321 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Benchmark harness: runs client.py against every server and collects
+the numbers into one comparison matrix.
+
+Every cell of the matrix (server x children x connections x payload
+size) gets a freshly started server on a free port, so the server's
+CPU time and peak RSS - taken from 'os.wait4' when it is stopped with
+SIGINT, children included - belong to that run alone.
+
+The results go to a CSV and/or JSON file. Given the JSON of an earlier
+run (--baseline), the harness compares the two and flags every cell
+that got slower, more expensive or bigger by more than --threshold
+percent; the exit status is 1 if there is any.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import sys
+import csv
+import json
+import time
+import signal
+import socket
+import optparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the pinned preforked servers sit next to the plain ones, the p99
+# column shows what CPU affinity is worth on this machine
+SERVERS = [
+    'server01.py',
+    'server02.py -m epoll',
+    'server03.py',
+    'server03.py --pin',
+    'server03.py -r --pin',
+    'server03a.py',
+    'server04.py',
+    'server04.py --pin',
+    'server05.py',
+    'server06.py',
+    'server07.py',
+    ]
+
+# columns of the matrix, latencies are the response latencies in ms
+COLUMNS = [
+    'server', 'child_num', 'con_num', 'bytes', 'requests', 'errors',
+    'requests_per_second', 'mb_per_second', 'p50', 'p90', 'p99', 'p99.9',
+    'max', 'server_cpu', 'server_rss',
+    ]
+KEY = ('server', 'child_num', 'con_num', 'bytes')
+
+# column -> True if a bigger value is better
+COMPARED = {
+    'requests_per_second': True,
+    'p99': False,
+    'server_cpu': False,
+    'server_rss': False,
+    }
+
+READY_TIMEOUT = 10
+# seconds a server gets to exit after SIGINT before it's killed
+STOP_TIMEOUT = 10
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(spec, port):
+    """Starts the server and waits until it accepts connections."""
+    args = [sys.executable] + spec.split() + ['-p', str(port)]
+    # own process group, SIGINT stops the children too like Ctrl-C does
+    proc = subprocess.Popen(
+        args, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise Exception('%s exited with status %d' % (spec, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+
+    stop_server(proc)
+    raise Exception('%s is not accepting connections' % spec)
+
+
+def stop_server(proc):
+    """Stops the server, returns its CPU time in seconds and peak RSS in
+    KiB, both including the children it reaped."""
+    try:
+        os.killpg(proc.pid, signal.SIGINT)
+    except ProcessLookupError:
+        pass
+    deadline = time.monotonic() + STOP_TIMEOUT
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.monotonic() >= deadline:
+            # ignores SIGINT or hangs in its cleanup, don't hang with it
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        time.sleep(0.05)
+    # don't let subprocess wait for it once more
+    proc.returncode = status
+    try:
+        # whatever is left of the process group
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss
+
+
+def run_client(port, child_num, con_num, bytes, client_args):
+    with tempfile.NamedTemporaryFile(suffix='.json') as results:
+        args = [sys.executable, 'client.py', '-i', '127.0.0.1',
+                '-p', str(port), '-c', str(child_num), '-t', str(con_num),
+                '-b', str(bytes), '-j', results.name] + client_args
+        client = subprocess.run(args, cwd=HERE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        # the numbers of a run with failed requests aren't comparable
+        if client.returncode:
+            raise Exception('client.py exited with status %d'
+                            % client.returncode)
+        return json.load(open(results.name))
+
+
+def run_cell(spec, child_num, con_num, bytes, client_args):
+    port = free_port()
+    proc = start_server(spec, port)
+    try:
+        results = run_client(port, child_num, con_num, bytes, client_args)
+    finally:
+        cpu, rss = stop_server(proc)
+
+    latency = results['latency']['response']
+    options = results['options']
+    expected = child_num * con_num * (
+        options['req_num'] if options['framed'] else 1)
+    row = {
+        'server': spec,
+        'child_num': child_num,
+        'con_num': con_num,
+        'bytes': bytes,
+        'requests': results['requests'],
+        'errors': expected - results['requests'],
+        'requests_per_second': results['requests_per_second'],
+        'mb_per_second': results['bytes_received'] / results['elapsed'] / 1e6,
+        'server_cpu': cpu,
+        'server_rss': rss,
+        }
+    for column in ('p50', 'p90', 'p99', 'p99.9', 'max'):
+        row[column] = latency[column]
+    return row
+
+
+def print_row(row):
+    print('%-24s c=%-4d t=%-5d b=%-9d %10.1f req/s  p99 %8.3f ms  '
+          'cpu %6.2f s  rss %7d KiB%s' % (
+              row['server'], row['child_num'], row['con_num'], row['bytes'],
+              row['requests_per_second'], row['p99'], row['server_cpu'],
+              row['server_rss'],
+              '  %d errors' % row['errors'] if row['errors'] else ''))
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_json(path, rows, client_args):
+    with open(path, 'w') as f:
+        json.dump({'client_args': client_args, 'rows': rows}, f, indent=2)
+
+
+def compare(rows, baseline, threshold):
+    """Returns a list of (row, column, old value, new value, change %) for
+    the columns that got worse by more than `threshold` percent."""
+    old_rows = dict(
+        (tuple(row[key] for key in KEY), row) for row in baseline['rows'])
+    regressions = []
+    for row in rows:
+        old = old_rows.get(tuple(row[key] for key in KEY))
+        if old is None:
+            continue
+        for column, bigger_is_better in COMPARED.items():
+            if not old[column]:
+                continue
+            change = 100.0 * (row[column] - old[column]) / old[column]
+            if bigger_is_better:
+                change = -change
+            if change > threshold:
+                regressions.append(
+                    (row, column, old[column], row[column], change))
+    return regressions
+
+
+def _split(value, type=int):
+    return [type(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options] [-- client.py options]')
+    parser.add_option(
+        '-s', '--server', dest='servers', action='append',
+        help=('Server to benchmark with its options, e.g. '
+              '"server03.py -n 4". May be given several times. '
+              'Default is all servers')
+        )
+    parser.add_option(
+        '-c', '--child-num', dest='child_nums', default='1,4,16',
+        help='Comma-separated client children counts. Default is 1,4,16'
+        )
+    parser.add_option(
+        '-t', '--con-num', dest='con_nums', default='100',
+        help='Comma-separated connections per child. Default is 100'
+        )
+    parser.add_option(
+        '-b', '--bytes', dest='bytes', default='1000,100000',
+        help='Comma-separated payload sizes. Default is 1000,100000'
+        )
+    parser.add_option(
+        '--csv', dest='csv', help='Write the matrix to this CSV file')
+    parser.add_option(
+        '--json', dest='json', help='Write the matrix to this JSON file')
+    parser.add_option(
+        '--baseline', dest='baseline',
+        help='Compare with the JSON matrix of an earlier run')
+    parser.add_option(
+        '--threshold', dest='threshold', type='float', default=10,
+        help=('Flag changes for the worse bigger than that many percent. '
+              'Default is 10')
+        )
+
+    options, client_args = parser.parse_args()
+
+    baseline = None
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        if not client_args:
+            # the same workload as the baseline
+            client_args = baseline['client_args']
+
+    rows = []
+    for spec in options.servers or SERVERS:
+        for bytes in _split(options.bytes):
+            for child_num in _split(options.child_nums):
+                for con_num in _split(options.con_nums):
+                    try:
+                        row = run_cell(
+                            spec, child_num, con_num, bytes, client_args)
+                    except Exception as e:
+                        print('%-24s c=%-4d t=%-5d b=%-9d failed: %s' % (
+                            spec, child_num, con_num, bytes, e))
+                        continue
+                    print_row(row)
+                    rows.append(row)
+
+    if options.csv:
+        write_csv(options.csv, rows)
+    if options.json:
+        write_json(options.json, rows, client_args)
+
+    if baseline is not None:
+        regressions = compare(rows, baseline, options.threshold)
+        print()
+        if not regressions:
+            print('No regressions over %.1f%%' % options.threshold)
+            return
+        print('Regressions over %.1f%%:' % options.threshold)
+        for row, column, old, new, change in regressions:
+            print('%-24s c=%-4d t=%-5d b=%-9d %-20s %12.3f -> %12.3f '
+                  '(%+.1f%% worse)' % (
+                      row['server'], row['child_num'], row['con_num'],
+                      row['bytes'], column, old, new, change))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
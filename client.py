@@ -26,33 +26,574 @@ __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
 
 import os
 import sys
+import math
+import mmap
+import json
+import time
 import errno
+import struct
 import socket
 import optparse
+import resource
+import selectors
+import collections
 
+import protocol
+import histogram
+
+# latencies measured by every child, each one in its own histogram:
+# connection setup, from sending a request to the first byte of the
+# response and to the whole response
+LATENCIES = ['connect', 'first byte', 'response']
+CONNECT, FIRST_BYTE, RESPONSE = range(len(LATENCIES))
+
+# anonymous memory-mapped file with a block for every child: the number
+# of bytes received followed by the latency histograms, the parent reads
+# them once the children are done
+MAP = None
+COUNTER_FMT = '<Q'
+COUNTER_SIZE = struct.calcsize(COUNTER_FMT)
+CHILD_BLOCK = COUNTER_SIZE + len(LATENCIES) * histogram.SIZE
+
+# how the request rate changes over an open-loop run (-R)
+PROFILES = ['constant', 'step', 'ramp']
+
+# payloads are read into a buffer of this size and thrown away
+SCRATCH_SIZE = 256 * 1024
+
+
+def _raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def open_idle(host, port, idle_num):
+    """Open idle_num connections that never send a request.
+
+    They only inflate the number of descriptors the server has to watch.
+    """
+    _raise_nofile_limit()
+
+    idle = []
+    for i in range(idle_num):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+        idle.append(sock)
+    return idle
+
+
+def recv_exactly(sock, view):
+    """Fill the whole buffer from the socket."""
+    while len(view):
+        nbytes = sock.recv_into(view)
+        if not nbytes:
+            raise Exception('Server closed the connection')
+        view = view[nbytes:]
+
+
+def recv_discard(sock, scratch, length):
+    """Read `length` bytes from the socket into the scratch buffer over
+    and over, returns fewer if the server closes the connection."""
+    left = length
+    while left:
+        nbytes = sock.recv_into(scratch, min(left, len(scratch)))
+        if not nbytes:
+            break
+        left -= nbytes
+    return length - left
+
+
+def framed_requests(sock, bytes, req_num, pipeline, buf, latencies,
+                    path=None, intended=None):
+    """Send req_num framed requests over the socket.
+
+    Up to `pipeline` requests are sent before waiting for a response.
+    With `path` the requests ask for that file instead of `bytes` bytes.
+    Latencies count from the `intended` send time of a single request,
+    if given, otherwise from the moment a request actually goes out.
+    Returns the number of payload bytes received.
+    """
+    if path is None:
+        request = protocol.pack_request(bytes)
+    else:
+        request = protocol.pack_file_request(path)
+    header = memoryview(bytearray(protocol.RESPONSE_HEADER.size))
+
+    # send times of the requests waiting for a response
+    sent_at = collections.deque()
+    sent = received = total = 0
+    while received < req_num:
+        # keep the pipeline full
+        burst = min(pipeline - (sent - received), req_num - sent)
+        if burst:
+            sock.sendall(request * burst)
+            sent_at.extend([intended or time.monotonic_ns()] * burst)
+            sent += burst
+
+        recv_exactly(sock, header)
+        first_byte = time.monotonic_ns()
+        status, length = protocol.unpack_response_header(header)
+        if status != protocol.OK:
+            message = bytearray(length)
+            recv_exactly(sock, memoryview(message))
+            raise Exception('Server returned an error: %s' % (
+                message.decode('utf-8', 'replace')))
+        if path is None and length != bytes:
+            raise Exception('Server returned %d bytes instead of %d' % (
+                length, bytes))
+        # the payload goes through the scratch buffer, whatever its size
+        if recv_discard(sock, buf, length) != length:
+            raise Exception('Server closed the connection')
+
+        started = sent_at.popleft()
+        latencies[FIRST_BYTE].record(first_byte - started)
+        latencies[RESPONSE].record(time.monotonic_ns() - started)
+        received += 1
+        total += length
+    return total
+
+
+def legacy_request(sock, bytes, buf, latencies, intended=None):
+    """Send a legacy request, returns the number of bytes received."""
+    started = intended or time.monotonic_ns()
+    sock.sendall(str(bytes).encode('utf-8'))
+
+    nbytes = sock.recv_into(buf, min(bytes, len(buf)))
+    latencies[FIRST_BYTE].record(time.monotonic_ns() - started)
+    # the payload may come in several pieces
+    if nbytes:
+        nbytes += recv_discard(sock, buf, bytes - nbytes)
+    if nbytes != bytes:
+        raise Exception('Server returned only %d bytes' % nbytes)
+    latencies[RESPONSE].record(time.monotonic_ns() - started)
+    return bytes
+
+
+def connect(host, port, latencies, framed):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connecting = time.monotonic_ns()
+    sock.connect((host, port))
+    latencies[CONNECT].record(time.monotonic_ns() - connecting)
+    if framed:
+        # pipelined requests are small, don't let Nagle's
+        # algorithm hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class Schedule(object):
+    """Send times of an open-loop run.
+
+    The rate goes from `rate` to `rate_to` requests/s over `duration`
+    seconds: it stays the same (constant), grows once per stage (step)
+    or grows continuously (ramp). Results are reported for every stage
+    of `stage` seconds.
+    """
+
+    def __init__(self, profile, rate, rate_to, duration, stage):
+        self.profile = profile
+        self.rate = rate
+        self.rate_to = rate if rate_to is None else rate_to
+        self.duration = duration
+        self.stage = stage
+        self.stages = max(1, int(math.ceil(duration / stage)))
+
+    def stage_index(self, seconds):
+        return max(0, min(int(seconds / self.stage), self.stages - 1))
+
+    def rate_at(self, seconds):
+        if self.profile == 'step':
+            index = self.stage_index(seconds)
+            return self.rate + (self.rate_to - self.rate) * index / max(
+                self.stages - 1, 1)
+        elif self.profile == 'ramp':
+            return self.rate + (self.rate_to - self.rate) * min(
+                seconds / self.duration, 1)
+        return self.rate
+
+    def stage_rate(self, index):
+        """The target rate in the middle of the stage"""
+        return self.rate_at((index + 0.5) * self.stage)
+
+    def times(self, share, phase):
+        """Yields send times, in seconds from the start, of a child that
+        sends `share` of all requests."""
+        seconds = phase
+        while seconds < self.duration:
+            yield seconds
+            seconds += 1.0 / (self.rate_at(seconds) * share)
+
+
+def open_loop(host, port, bytes, framed, path, buf, latencies,
+              schedule, share, phase, start, stages, completed):
+    """Send requests at the times set by the schedule.
+
+    A request that is late because the previous response took too long
+    goes out right away, but its latency still counts from the time it
+    should have been sent - otherwise a stalled server would be measured
+    by the few requests that went out, not by the ones that waited.
+    """
+    sock = None
+    received = 0
+    for seconds in schedule.times(share, phase):
+        intended = start + int(seconds * 1e9)
+        delay = intended - time.monotonic_ns()
+        if delay > 0:
+            time.sleep(delay / 1e9)
+
+        if sock is None:
+            sock = connect(host, port, latencies, framed)
+        if framed:
+            # one connection for the whole run
+            received += framed_requests(
+                sock, bytes, 1, 1, buf, latencies, path, intended)
+        else:
+            received += legacy_request(sock, bytes, buf, latencies, intended)
+            sock.close()
+            sock = None
+
+        done = time.monotonic_ns()
+        stages[schedule.stage_index(seconds)].record(done - intended)
+        completed[schedule.stage_index((done - start) / 1e9)] += 1
+
+    if sock is not None:
+        sock.close()
+    return received
+
+
+class Connection(object):
+    """Non-blocking client connection driven by the event loop (--async).
+
+    Sends up to `pipeline` requests at a time until `req_num` responses
+    have arrived; a legacy connection sends one request and reads until
+    the whole payload is in.
+    """
+
+    def __init__(self, host, port, bytes, framed, req_num, pipeline, path):
+        self.bytes = bytes
+        self.framed = framed
+        self.req_num = req_num
+        self.pipeline = pipeline
+        self.path = path
+        if not framed:
+            self.request = str(bytes).encode('utf-8')
+        elif path is None:
+            self.request = protocol.pack_request(bytes)
+        else:
+            self.request = protocol.pack_file_request(path)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.connecting = time.monotonic_ns()
+        self.connected = False
+        self.sock.connect_ex((host, port))
+
+        # request bytes not sent yet and send times of the requests
+        # waiting for a response
+        self.out = memoryview(b'')
+        self.sent_at = collections.deque()
+        self.sent = self.received = self.payload = 0
+        # the response being read: its header (framed), the time of
+        # its first byte and the number of payload bytes still to come
+        self.header = bytearray(protocol.RESPONSE_HEADER.size)
+        self.header_got = 0
+        self.first_byte = None
+        self.left = None if framed else bytes
+
+    def events(self):
+        if not self.connected or self.out:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def handle(self, events, scratch, latencies):
+        """Returns True once all responses have arrived."""
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise OSError(error, os.strerror(error))
+            if not events & selectors.EVENT_WRITE:
+                return False
+            latencies[CONNECT].record(time.monotonic_ns() - self.connecting)
+            self.connected = True
+            if self.framed:
+                # pipelined requests are small, don't let Nagle's
+                # algorithm hold them back
+                self.sock.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.fill()
+
+        if events & selectors.EVENT_WRITE and self.out:
+            try:
+                self.out = self.out[self.sock.send(self.out):]
+            except BlockingIOError:
+                pass
+
+        if events & selectors.EVENT_READ:
+            return self.read(scratch, latencies)
+        return False
+
+    def fill(self):
+        # keep the pipeline full
+        burst = min(self.pipeline - (self.sent - self.received),
+                    self.req_num - self.sent)
+        if burst:
+            self.out = memoryview(bytes(self.out) + self.request * burst)
+            self.sent_at.extend([time.monotonic_ns()] * burst)
+            self.sent += burst
+
+    def read(self, scratch, latencies):
+        try:
+            nbytes = self.sock.recv_into(scratch)
+        except BlockingIOError:
+            return False
+        if not nbytes:
+            raise Exception('Server closed the connection')
+        now = time.monotonic_ns()
+
+        # the data may hold the end of one response and the beginning
+        # of the next one, the payload itself is thrown away
+        view = scratch[:nbytes]
+        while view:
+            if self.first_byte is None:
+                self.first_byte = now
+            if self.left is None:
+                take = min(len(view), len(self.header) - self.header_got)
+                self.header[self.header_got:self.header_got + take] = \
+                    view[:take]
+                self.header_got += take
+                view = view[take:]
+                if self.header_got < len(self.header):
+                    break
+                status, length = protocol.unpack_response_header(self.header)
+                if status != protocol.OK:
+                    raise Exception('Server returned an error')
+                if self.path is None and length != self.bytes:
+                    raise Exception('Server returned %d bytes instead of %d'
+                                    % (length, self.bytes))
+                self.header_got = 0
+                self.left = length
+
+            take = min(len(view), self.left)
+            self.left -= take
+            self.payload += take
+            view = view[take:]
+            if self.left:
+                break
+
+            started = self.sent_at.popleft()
+            latencies[FIRST_BYTE].record(self.first_byte - started)
+            latencies[RESPONSE].record(now - started)
+            self.received += 1
+            if self.received == self.req_num:
+                return True
+            self.first_byte = self.left = None
+            self.fill()
+        return False
+
+
+def async_requests(host, port, con_num, bytes, framed, req_num, pipeline,
+                   path, latencies):
+    """Run con_num connections at the same time in one event loop.
+
+    Returns the number of payload bytes received and the errors of the
+    connections that failed.
+    """
+    _raise_nofile_limit()
+    selector = selectors.DefaultSelector()
+    scratch = memoryview(bytearray(SCRATCH_SIZE))
+
+    for i in range(con_num):
+        conn = Connection(host, port, bytes, framed, req_num, pipeline, path)
+        selector.register(conn.sock, conn.events(), conn)
+
+    received = 0
+    errors = []
+    active = con_num
+    while active:
+        for key, events in selector.select():
+            conn = key.data
+            try:
+                done = conn.handle(events, scratch, latencies)
+            except Exception as e:
+                errors.append(e)
+                done = True
+            if done:
+                received += conn.payload
+                selector.unregister(conn.sock)
+                conn.sock.close() # TIME_WAIT state on the client
+                active -= 1
+            elif conn.events() != key.events:
+                selector.modify(conn.sock, conn.events(), conn)
+
+    selector.close()
+    return received, errors
+
+
+def child_block(stage_num):
+    """Size of a child's block: bytes received, the latency histograms,
+    then a histogram and the number of completed requests per stage"""
+    return CHILD_BLOCK + stage_num * (histogram.SIZE + COUNTER_SIZE)
+
+
+def save_results(cnum, received, latencies, stages=(), completed=()):
+    """Store the child's results in its block of the shared map."""
+    offset = cnum * child_block(len(stages))
+    struct.pack_into(COUNTER_FMT, MAP, offset, received)
+    offset += COUNTER_SIZE
+    for latency in latencies + list(stages):
+        latency.pack_into(MAP, offset)
+        offset += histogram.SIZE
+    for count in completed:
+        struct.pack_into(COUNTER_FMT, MAP, offset, count)
+        offset += COUNTER_SIZE
+
+
+def load_results(child_num, stage_num=0):
+    """Returns the number of bytes received, the latency histograms and
+    the stage histograms and completed requests of all children added
+    up."""
+    received = 0
+    latencies = [histogram.Histogram() for name in LATENCIES]
+    stages = [histogram.Histogram() for index in range(stage_num)]
+    completed = [0] * stage_num
+    for cnum in range(child_num):
+        offset = cnum * child_block(stage_num)
+        received += struct.unpack_from(COUNTER_FMT, MAP, offset)[0]
+        offset += COUNTER_SIZE
+        for latency in latencies + stages:
+            latency.merge(histogram.Histogram.unpack_from(MAP, offset))
+            offset += histogram.SIZE
+        for index in range(stage_num):
+            completed[index] += struct.unpack_from(
+                COUNTER_FMT, MAP, offset)[0]
+            offset += COUNTER_SIZE
+    return received, latencies, stages, completed
+
+
+def print_results(requests, elapsed, received, latencies):
+    print('%d requests in %.3f s, %.1f requests/s, %.1f MB/s' % (
+        requests, elapsed, requests / elapsed, received / elapsed / 1e6))
+    print()
+    columns = ['p%s' % percentile for percentile in histogram.PERCENTILES]
+    columns += ['max']
+    print('%-12s' % 'latency, ms' + ''.join('%11s' % c for c in columns))
+    for name, latency in zip(LATENCIES, latencies):
+        summary = latency.summary()
+        print('%-12s' % name +
+              ''.join('%11.3f' % summary[column] for column in columns))
+
+
+def print_stages(schedule, stages, completed):
+    print()
+    print('latency from the intended send time, ms')
+    columns = ['p%s' % percentile for percentile in histogram.PERCENTILES]
+    columns += ['max']
+    print('%-6s%11s%11s' % ('stage', 'target/s', 'actual/s') +
+          ''.join('%11s' % c for c in columns))
+    for index, latency in enumerate(stages):
+        summary = latency.summary()
+        print('%-6d%11.1f%11.1f' % (
+            index, schedule.stage_rate(index),
+            completed[index] / schedule.stage) +
+            ''.join('%11.3f' % summary[column] for column in columns))
+
+
+def write_json(path, options, requests, elapsed, received, latencies,
+               schedule=None, stages=(), completed=()):
+    results = {
+        'options': options,
+        'requests': requests,
+        'elapsed': elapsed,
+        'requests_per_second': requests / elapsed,
+        'bytes_received': received,
+        # latencies in milliseconds
+        'latency': dict(
+            (name, latency.summary())
+            for name, latency in zip(LATENCIES, latencies)),
+        }
+    if schedule is not None:
+        results['stages'] = [
+            {'target': schedule.stage_rate(index),
+             'actual': completed[index] / schedule.stage,
+             'latency': latency.summary()}
+            for index, latency in enumerate(stages)]
+    if path == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def request(host, port, child_num, con_num, bytes, idle_num=0,
+            framed=False, req_num=1, pipeline=1, path=None, json_path=None,
+            schedule=None, use_async=False):
+    stage_num = schedule.stages if schedule is not None else 0
+    global MAP
+    MAP = mmap.mmap(-1, child_num * child_block(stage_num))
+
+    idle = open_idle(host, port, idle_num)
+    started = time.monotonic()
+    # open-loop children share the clock the schedule starts from,
+    # give them time to fork
+    start = time.monotonic_ns() + 100 * 1000000
 
-def request(host, port, child_num, con_num, bytes):
     # spawn child_num children processes
     for cnum in range(child_num):
 
         pid = os.fork()
         if pid == 0: # child
+            for sock in idle:
+                sock.close()
 
-            for i in range(con_num):
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, port))
-                sock.sendall(str(bytes).encode('utf-8'))
+            # responses are read and thrown away, a chunk at a time
+            buf = memoryview(bytearray(SCRATCH_SIZE))
+            latencies = [histogram.Histogram() for name in LATENCIES]
+            received = 0
+
+            if schedule is not None:
+                stages = [histogram.Histogram() for index in range(stage_num)]
+                completed = [0] * stage_num
+                # children take turns, each one sends every
+                # child_num-th request
+                phase = cnum / schedule.rate_at(0)
+                received = open_loop(
+                    host, port, bytes, framed, path, buf, latencies,
+                    schedule, 1.0 / child_num, phase, start,
+                    stages, completed)
+                save_results(cnum, received, latencies, stages, completed)
+                print('Child %d is done' % cnum)
+                os._exit(0)
 
-                data = sock.recv(bytes)
-                if len(data) != bytes:
-                    raise Exception('Server returned only %d bytes' % len(data))
+            if use_async:
+                received, errors = async_requests(
+                    host, port, con_num, bytes, framed, req_num, pipeline,
+                    path, latencies)
+                save_results(cnum, received, latencies)
+                if errors:
+                    print('Child %d: %d connections failed, the last one '
+                          'with: %s' % (cnum, len(errors), errors[-1]))
+                    os._exit(1)
+                print('Child %d is done' % cnum)
+                os._exit(0)
+
+            for i in range(con_num):
+                sock = connect(host, port, latencies, framed)
+                if framed:
+                    received += framed_requests(
+                        sock, bytes, req_num, pipeline, buf, latencies, path)
+                else:
+                    received += legacy_request(sock, bytes, buf, latencies)
 
                 sock.close() # TIME_WAIT state on the client
 
+            save_results(cnum, received, latencies)
             print('Child %d is done' % cnum)
             os._exit(0)
 
     # wait for all children to finish
+    failed = 0
     while True:
         try:
             pid, status = os.wait()
@@ -64,6 +605,35 @@ def request(host, port, child_num, con_num, bytes):
 
         if pid == 0:
             break
+        if status: # a request failed or the child was killed
+            failed += 1
+
+    elapsed = time.monotonic() - started
+    for sock in idle:
+        sock.close()
+
+    received, latencies, stages, completed = load_results(
+        child_num, stage_num)
+    # children that failed don't count
+    requests = latencies[RESPONSE].count
+    print_results(requests, elapsed, received, latencies)
+    if schedule is not None:
+        print_stages(schedule, stages, completed)
+    if json_path:
+        options = dict(
+            host=host, port=port, child_num=child_num, con_num=con_num,
+            bytes=bytes, idle_num=idle_num, framed=framed, req_num=req_num,
+            pipeline=pipeline, path=path, use_async=use_async)
+        if schedule is not None:
+            options.update(
+                profile=schedule.profile, rate=schedule.rate,
+                rate_to=schedule.rate_to, duration=schedule.duration,
+                stage=schedule.stage)
+        write_json(json_path, options, requests, elapsed, received,
+                   latencies, schedule, stages, completed)
+    if failed:
+        print('%d of %d children failed' % (failed, child_num))
+    return failed
 
 
 def main():
@@ -86,14 +656,94 @@ def main():
         help='Number of bytes to request. Default is 3000'
         )
 
+    parser.add_option(
+        '-k', '--idle', dest='idle', type='int', default=0,
+        help=('Number of idle connections to hold open during the run. '
+              'Default is 0')
+        )
+
+    parser.add_option(
+        '-f', '--framed', dest='framed', action='store_true', default=False,
+        help=('Use the framed protocol, implied by -r and -l. '
+              'Default is the legacy protocol')
+        )
+    parser.add_option(
+        '-r', '--requests', dest='reqnum', type='int', default=1,
+        help='Number of requests per connection. Default is 1'
+        )
+    parser.add_option(
+        '-l', '--pipeline', dest='pipeline', type='int', default=1,
+        help=('Number of requests sent without waiting for a response. '
+              'Default is 1')
+        )
+    parser.add_option(
+        '-F', '--file', dest='path',
+        help=('Request this file (relative to the server\'s --docroot) '
+              'instead of -b bytes, implies -f')
+        )
+    parser.add_option(
+        '-j', '--json', dest='json',
+        help='Also write the results as JSON to this file, - for stdout'
+        )
+
+    parser.add_option(
+        '-a', '--async', dest='use_async', action='store_true',
+        default=False,
+        help=('Every child runs its -t connections at the same time in '
+              'one event loop instead of one after another')
+        )
+
+    parser.add_option(
+        '-R', '--rate', dest='rate', type='float',
+        help=('Open loop: send this many requests/s (all children '
+              'together) on a fixed schedule instead of -t connections '
+              'back to back')
+        )
+    parser.add_option(
+        '-d', '--duration', dest='duration', type='float', default=10,
+        help='Length of an open-loop run in seconds. Default is 10'
+        )
+    parser.add_option(
+        '-P', '--profile', dest='profile', default='constant',
+        choices=PROFILES,
+        help=('How the rate changes from -R to --rate-to: %s. '
+              'Default is constant' % ', '.join(PROFILES))
+        )
+    parser.add_option(
+        '--rate-to', dest='rate_to', type='float',
+        help='The final rate of the step and ramp profiles'
+        )
+    parser.add_option(
+        '--stage', dest='stage', type='float', default=1,
+        help=('Report open-loop results (and step the rate) every that '
+              'many seconds. Default is 1')
+        )
+
     options, args = parser.parse_args()
 
     if not (options.host and options.port):
         parser.print_help()
         sys.exit(1)
 
-    request(options.host, options.port,
-            options.childnum, options.connum, options.bytes)
+    framed = (options.framed or options.reqnum > 1 or options.pipeline > 1
+              or options.path is not None)
+    schedule = None
+    if options.rate and options.use_async:
+        parser.error('-R works with blocking children only, drop -a')
+    # a rate of 0 would never get to the next send time
+    for name, rate in (('-R', options.rate), ('--rate-to', options.rate_to)):
+        if rate is not None and rate <= 0:
+            parser.error('%s must be a positive number of requests/s' % name)
+    if options.rate:
+        schedule = Schedule(options.profile, options.rate, options.rate_to,
+                            options.duration, options.stage)
+    failed = request(
+        options.host, options.port,
+        options.childnum, options.connum, options.bytes, options.idle,
+        framed, options.reqnum, options.pipeline, options.path,
+        options.json, schedule, options.use_async)
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
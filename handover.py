@@ -0,0 +1,187 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Zero-downtime restart of the preforked servers.
+
+On SIGHUP (or SIGUSR2) the running master starts a new one, the same
+program with the same command line, and passes it its listening
+sockets over a Unix socket pair (SCM_RIGHTS, see server04.py). The
+kernel objects stay open all along, so connections keep queueing up in
+the same accept queues and no client is refused. Once the new master
+has forked its children and says it's ready, the old one stops
+accepting, lets its children finish the connections they have and
+exits. If the new master doesn't come up, the old one carries on.
+
+The new master finds the socket pair's descriptor in the UPGRADE_FD
+environment variable.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import sys
+import json
+import time
+import select
+import signal
+import socket
+import subprocess
+
+ENV = 'UPGRADE_FD'
+
+# signals that start an upgrade
+SIGNALS = (signal.SIGHUP, signal.SIGUSR2)
+
+# the kernel's limit on descriptors in one message, SCM_MAX_FD
+MAX_FDS = 253
+
+# how long the new master may take to start
+READY_TIMEOUT = 10
+
+# how long the old children may take to finish their connections
+DRAIN_TIMEOUT = 60
+
+# the new master's end of the socket pair until it's ready
+CHANNEL = None
+
+
+def inherit():
+    """Returns the sockets passed by the old master by name, lists of
+    them in the order they were passed; nothing if there's no upgrade."""
+    fd = os.environ.pop(ENV, None)
+    if fd is None:
+        return {}
+
+    global CHANNEL
+    CHANNEL = socket.socket(fileno=int(fd))
+    msg, fds, flags, address = socket.recv_fds(CHANNEL, 4096, MAX_FDS)
+    inherited = {}
+    for name, fd in zip(json.loads(msg.decode('ascii')), fds):
+        # the family and type come from the descriptor
+        inherited.setdefault(name, []).append(socket.socket(fileno=fd))
+    print('Took over %d sockets from the old master' % len(fds))
+    return inherited
+
+
+def ready():
+    """Tell the old master the new one is up and it can leave."""
+    global CHANNEL
+    if CHANNEL is None:
+        return
+    try:
+        CHANNEL.sendall(b'ready')
+    except OSError:
+        pass
+    CHANNEL.close()
+    CHANNEL = None
+
+
+class Successor(object):
+    """A new master being started with `socks`, a list of (name, socket).
+
+    The old one may go on serving meanwhile: the successor is readable
+    (see fileno) once it has answered or gone, 'check' tells which.
+    """
+
+    def __init__(self, socks):
+        self.channel, successor_end = socket.socketpair()
+        env = dict(os.environ)
+        env[ENV] = str(successor_end.fileno())
+        print('Starting a new master ...')
+        self.proc = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                                     pass_fds=[successor_end.fileno()])
+        successor_end.close()
+        self.deadline = time.monotonic() + READY_TIMEOUT
+
+        names = json.dumps([name for name, sock in socks]).encode('ascii')
+        try:
+            # a fresh socket buffer takes the message without blocking
+            socket.send_fds(self.channel, [names],
+                            [sock.fileno() for name, sock in socks])
+        except OSError:
+            # 'check' finds the channel closed
+            pass
+        self.channel.setblocking(False)
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def timeout(self):
+        """Seconds left until the successor is given up on."""
+        return max(self.deadline - time.monotonic(), 0)
+
+    def check(self):
+        """Returns True if the successor is ready, False if it failed
+        (it's killed then) and None if it's still starting."""
+        try:
+            answer = self.channel.recv(16)
+        except BlockingIOError:
+            if time.monotonic() < self.deadline:
+                return None
+            answer = b''
+        except OSError:
+            answer = b''
+        self.channel.close()
+
+        if answer != b'ready':
+            print('The new master (PID: %s) failed to start' % self.proc.pid)
+            self.proc.kill()
+            return False
+        print('The new master (PID: %s) is ready' % self.proc.pid)
+        return True
+
+    def wait(self):
+        """Block until the successor is ready or has failed."""
+        while True:
+            select.select([self], [], [], self.timeout())
+            ready = self.check()
+            if ready is not None:
+                return ready
+
+
+def start_successor(socks):
+    """Start a new master and pass it `socks`, a list of (name, socket).
+    Returns True once it's ready."""
+    return Successor(socks).wait()
+
+
+def drain(pids, timeout=DRAIN_TIMEOUT):
+    """Wait until the children `pids` finish their connections and exit,
+    kill the ones still there after `timeout` seconds."""
+    pids = set(pids)
+    deadline = time.monotonic() + timeout
+    while pids:
+        for pid in list(pids):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    pids.remove(pid)
+            except ChildProcessError:
+                pids.remove(pid)
+        if pids and time.monotonic() > deadline:
+            print('Killing %d children still busy' % len(pids))
+            for pid in pids:
+                os.kill(pid, signal.SIGKILL)
+            deadline = float('inf')
+        time.sleep(0.05)
@@ -0,0 +1,118 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Log-bucketed latency histograms.
+
+Latencies are recorded in nanoseconds. Every power of two is split into
+SUB_BUCKETS buckets, so a percentile read off the histogram is at most
+~4.4% (2 ** (1/16)) above the real value at any scale, from microseconds
+on loopback to seconds under overload. The number of samples, their sum
+and the exact maximum are kept alongside.
+
+Processes share their histograms by packing them into a memory-mapped
+file (pack_into/unpack_from), the reader adds them up with merge().
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import math
+import struct
+
+SUB_BUCKETS = 16
+# the last bucket takes everything above 2 ** 40 ns (~18 minutes)
+BUCKETS = 40 * SUB_BUCKETS
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# number of samples, their sum, max and the buckets
+STRUCT = struct.Struct('<%dQ' % (3 + BUCKETS))
+SIZE = STRUCT.size
+
+
+def bucket(nanos):
+    return min(int(math.log2(nanos + 1) * SUB_BUCKETS), BUCKETS - 1)
+
+
+def bucket_value(index):
+    """The upper bound of the bucket in nanoseconds"""
+    return 2 ** ((index + 1) / SUB_BUCKETS) - 1
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, nanos):
+        self.buckets[bucket(nanos)] += 1
+        self.count += 1
+        self.total += nanos
+        if nanos > self.max:
+            self.max = nanos
+
+    def merge(self, other):
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """Returns the latency in nanoseconds."""
+        if not self.count:
+            return 0
+        # the first bucket that covers the percentile
+        threshold, seen = self.count * percentile / 100.0, 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                break
+        return min(bucket_value(index), self.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def summary(self):
+        """Returns the number of samples and latencies in milliseconds."""
+        summary = {'count': self.count, 'mean': self.mean() / 1e6}
+        for percentile in PERCENTILES:
+            summary['p%s' % percentile] = self.percentile(percentile) / 1e6
+        summary['max'] = self.max / 1e6
+        return summary
+
+    def pack_into(self, buf, offset):
+        STRUCT.pack_into(buf, offset, self.count, self.total, self.max,
+                         *self.buckets)
+
+    @classmethod
+    def unpack_from(cls, buf, offset):
+        histogram = cls()
+        values = STRUCT.unpack_from(buf, offset)
+        histogram.count, histogram.total, histogram.max = values[:3]
+        histogram.buckets = list(values[3:])
+        return histogram
@@ -0,0 +1,176 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Listening sockets shared by all servers: the backlog, accepting and
+accept queue overflows.
+
+The kernel queues completed connections until the server accepts them,
+up to the backlog given to 'listen' (--backlog, capped by
+net.core.somaxconn). Once the queue is full new connections are dropped
+and clients wait for a SYN retransmit, a second or more. The servers
+that wait for a readable listening socket accept until EAGAIN, at most
+--accept-batch connections per wakeup so the connections they already
+have aren't starved.
+
+Connections come out of 'socket.accept' close-on-exec (it calls
+'accept4' with SOCK_CLOEXEC where there is one) and are then made
+non-blocking with 'setblocking', so the socket object's timeout agrees
+with the descriptor's O_NONBLOCK flag.
+
+When the server stops it prints how many connections the host's accept
+queues turned away meanwhile (ListenOverflows in /proc/net/netstat, the
+kernel doesn't count them per socket) and what is still waiting in its
+own queues (TCP_INFO).
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import errno
+import socket
+import struct
+
+# the kernel caps it at net.core.somaxconn
+BACKLOG = socket.SOMAXCONN
+
+# max number of connections accepted per wakeup
+ACCEPT_BATCH = 64
+
+# the first fields of struct tcp_info: for a listening socket
+# tcpi_unacked is the length of the accept queue and tcpi_sacked
+# the backlog it was created with
+TCP_INFO = struct.Struct('8B6I')
+UNACKED, SACKED = 12, 13
+
+# the listening sockets and the host's (ListenOverflows, ListenDrops)
+# when the first of them started listening
+LISTENERS = []
+OVERFLOWS = None
+
+
+def listen(sock, backlog=BACKLOG):
+    """Start listening (a socket taken over from the old master gets the
+    new backlog) and count the accept queue overflows from now on."""
+    global OVERFLOWS
+    sock.listen(backlog)
+    if sock not in LISTENERS:
+        LISTENERS.append(sock)
+    if OVERFLOWS is None:
+        OVERFLOWS = listen_overflows()
+
+
+def accept(listen_sock, blocking=False):
+    """Returns a new connection, non-blocking unless `blocking` and never
+    inherited by exec'ed programs. Raises OSError with EAGAIN when a
+    non-blocking listening socket has nothing to accept."""
+    conn, client_address = listen_sock.accept()
+    conn.setblocking(blocking)
+    return conn
+
+
+def accept_batch(listen_sock, maxconns=ACCEPT_BATCH, blocking=False):
+    """Accept until the queue is empty or there are `maxconns`
+    connections, the listening socket must be non-blocking."""
+    conns = []
+    while len(conns) < maxconns:
+        try:
+            conns.append(accept(listen_sock, blocking))
+        except IOError as e:
+            code, msg = e.args
+            # ECONNABORTED: the client gave up while in the queue
+            if code in (errno.EINTR, errno.ECONNABORTED):
+                continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            else:
+                raise
+    return conns
+
+
+def listen_overflows():
+    """Returns the host's (ListenOverflows, ListenDrops) counters, or None
+    if the kernel doesn't report them."""
+    try:
+        with open('/proc/net/netstat') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    # pairs of lines: the names, then the values
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith('TcpExt:'):
+            counters = dict(zip(names.split()[1:],
+                                [int(value) for value in values.split()[1:]]))
+            return (counters.get('ListenOverflows', 0),
+                    counters.get('ListenDrops', 0))
+    return None
+
+
+def overflows_since(start):
+    """Returns the (ListenOverflows, ListenDrops) counted since `start`,
+    None if unknown."""
+    now = listen_overflows()
+    if now is None or start is None:
+        return None
+    return now[0] - start[0], now[1] - start[1]
+
+
+def accept_queue(listen_sock):
+    """Returns the number of connections waiting in the socket's accept
+    queue and the queue's limit, or None if the kernel doesn't say."""
+    try:
+        info = listen_sock.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except (AttributeError, OSError):
+        return None
+    values = TCP_INFO.unpack_from(info.ljust(TCP_INFO.size, b'\0'))
+    return values[UNACKED], values[SACKED]
+
+
+def print_overflows():
+    """Print what's waiting in the accept queues and how many connections
+    didn't fit since the server started listening."""
+    queues = [queue for queue in map(accept_queue, LISTENERS)
+              if queue is not None]
+    if queues:
+        print('accept queue: %d waiting, backlog %d' % (
+            sum(waiting for waiting, limit in queues), queues[0][1]))
+    overflows = overflows_since(OVERFLOWS)
+    if overflows is not None:
+        print('listen overflows: %d, drops: %d (all sockets of the host)'
+              % overflows)
+
+
+def add_options(parser, batch=True):
+    """`batch` - the server accepts several connections per wakeup."""
+    parser.add_option(
+        '--backlog', dest='backlog', type='int', default=BACKLOG,
+        help=('Max number of connections waiting in the accept queue. '
+              'Default is %d' % BACKLOG))
+
+    if batch:
+        parser.add_option(
+            '--accept-batch', dest='accept_batch', type='int',
+            default=ACCEPT_BATCH,
+            help=('Max number of connections accepted per wakeup. '
+                  'Default is %d' % ACCEPT_BATCH))
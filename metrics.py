@@ -0,0 +1,193 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Live metrics of the preforked servers.
+
+With --metrics the parent listens on one more socket, a TCP port or a
+Unix socket, and answers every connection on it with a plain-text report
+(one 'name value' per line, the Prometheus text format) and closes it:
+
+    nc 127.0.0.1 9000
+    nc -U /tmp/server.sock
+
+The report is built from the children's stats slab (see stats.py) when
+it is asked for. Children don't do anything for it: they update their
+counters anyway and the parent only reads them.
+
+Accept-queue overruns come from the kernel: ListenOverflows and
+ListenDrops in /proc/net/netstat (all listening sockets of the host,
+counted since the server started) and the current length of every
+listening socket's queue from TCP_INFO, see listener.py.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import time
+import socket
+
+import stats
+import listener
+import histogram
+
+# where to listen when only the port is given
+HOST = '127.0.0.1'
+
+# upper bounds of the reported latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUANTILES = (50, 90, 99, 99.9)
+
+
+def create_sock(address):
+    """Listen on `address`: a port, host:port or a Unix socket path."""
+    if '/' in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # a socket file left by the previous run
+        if os.path.exists(address):
+            os.unlink(address)
+        sock.bind(address)
+    else:
+        host, sep, port = address.rpartition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host or HOST, int(port)))
+    sock.listen(5)
+    sock.setblocking(0)
+    print('Metrics on %s ...' % address)
+    return sock
+
+
+class Reporter(object):
+    """Answers connections to the metrics socket with a report on the
+    children of `slab` and the server's `listeners`. Only the `counters`
+    the children keep are reported."""
+
+    def __init__(self, address, slab, listeners, sock=None,
+                 counters=stats.COUNTERS):
+        # a restarted server takes over the old one's socket
+        self.sock = sock if sock is not None else create_sock(address)
+        self.slab = slab
+        self.counters = counters
+        # the same socket may be shared by all children
+        self.listeners = []
+        for listen_sock in listeners:
+            if listen_sock not in self.listeners:
+                self.listeners.append(listen_sock)
+        self.started = time.monotonic()
+        self.overflows = listener.listen_overflows()
+        # requests/s is counted since the previous report
+        self.last = self.started, 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def serve(self, in_flight=None):
+        """Answer the pending connections. `in_flight` is the number of
+        connections every running child has not finished yet, by default
+        every slot of the slab is a child and knows it."""
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                # a report fits in the socket buffer, but don't let a
+                # stuck reader hang the parent
+                conn.settimeout(1)
+                conn.sendall(self.report(in_flight).encode('ascii'))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def report(self, in_flight=None):
+        snapshots = self.slab.snapshot_all()
+        totals = self.slab.totals(snapshots)
+        if in_flight is None:
+            in_flight = [child.accepts - child.handled for child in snapshots]
+        busy = sum(1 for count in in_flight if count)
+
+        now = time.monotonic()
+        since, requests = self.last
+        self.last = now, totals.requests
+
+        lines = [
+            'uptime_seconds %.3f' % (now - self.started),
+            'requests_per_second %.1f' % (
+                (totals.requests - requests) / max(now - since, 1e-9)),
+            'in_flight %d' % sum(in_flight),
+            'children %d' % len(in_flight),
+            'children_busy %d' % busy,
+            'children_free %d' % (len(in_flight) - busy),
+            ]
+        for name, value in zip(stats.COUNTERS, totals):
+            if name not in self.counters:
+                continue
+            if name == 'busy_ns':
+                lines.append('busy_seconds_total %.3f' % (value / 1e9))
+            else:
+                lines.append('%s_total %d' % (name, value))
+
+        overflows = listener.overflows_since(self.overflows)
+        if overflows is not None:
+            lines.append('listen_overflows_total %d' % overflows[0])
+            lines.append('listen_drops_total %d' % overflows[1])
+        for index, listen_sock in enumerate(self.listeners):
+            queue = listener.accept_queue(listen_sock)
+            if queue is not None:
+                lines.append('accept_queue{listener="%d"} %d' % (
+                    index, queue[0]))
+                lines.append('accept_queue_limit{listener="%d"} %d' % (
+                    index, queue[1]))
+
+        lines.extend(self.latency_lines(self.slab.histogram()))
+        return '\n'.join(lines) + '\n'
+
+    def latency_lines(self, latencies):
+        # cumulative counts of the histogram buckets below every bound
+        lines, index, seen = [], 0, 0
+        for bound in LATENCY_BUCKETS:
+            while (index < histogram.BUCKETS and
+                   histogram.bucket_value(index) <= bound * 1e9):
+                seen += latencies.buckets[index]
+                index += 1
+            lines.append('latency_seconds_bucket{le="%s"} %d' % (bound, seen))
+        lines.append('latency_seconds_bucket{le="+Inf"} %d' % latencies.count)
+        lines.append('latency_seconds_sum %.6f' % (latencies.total / 1e9))
+        lines.append('latency_seconds_count %d' % latencies.count)
+        for quantile in QUANTILES:
+            lines.append('latency_seconds{quantile="%g"} %.6f' % (
+                quantile / 100.0, latencies.percentile(quantile) / 1e9))
+        lines.append('latency_seconds_max %.6f' % (latencies.max / 1e9))
+        return lines
+
+
+def add_options(parser):
+    parser.add_option(
+        '--metrics', dest='metrics', metavar='ADDRESS',
+        help=('Serve live metrics on this port, host:port or Unix socket '
+              'path. Default is off'))
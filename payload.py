@@ -0,0 +1,164 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Response payload shared by the servers.
+
+The payload pool is an anonymous memory-mapped file filled with random
+bytes once at startup. Created before forking, it is shared by all the
+children (nobody writes to it, so no page is ever copied), and every
+response is sent as memoryview slices of the pool - no allocation and
+no random number generation per request.
+
+Servers that need fresh random bytes for every response can still ask
+for them with --random.
+
+Either way a response is produced and sent chunk by chunk (Stream): a
+slice of the pool at a time, or CHUNK_SIZE random bytes generated into
+a buffer that is reused for the whole response. A worker's memory
+doesn't grow with the number of bytes a client asks for.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import mmap
+import resource
+
+import protocol
+import static
+
+POOL_SIZE = 4 * 1024 * 1024
+
+# memoryview of the pool or None in the random mode
+POOL = None
+
+# size of the buffer random bytes are generated into
+CHUNK_SIZE = 64 * 1024
+
+# /dev/urandom in the random mode, read straight into the buffers
+URANDOM = None
+
+
+def create_pool(size=POOL_SIZE):
+    """Creates anonymous memory mapped file with `size` random bytes"""
+    pool = mmap.mmap(-1, size)
+    while pool.tell() < size:
+        pool.write(os.urandom(min(size - pool.tell(), 65536)))
+    return memoryview(pool)
+
+
+def init(size=POOL_SIZE, random=False):
+    """Must be called before forking so children share the pool."""
+    global POOL, URANDOM
+    POOL = None if random else create_pool(size)
+    URANDOM = open('/dev/urandom', 'rb', buffering=0) if random else None
+
+
+class Stream(object):
+    """Payload of one response, produced chunk by chunk.
+
+    next_chunk() returns the part of the current chunk that is not sent
+    yet, consume() marks bytes of it as sent. len() is the number of
+    bytes left to send.
+    """
+
+    def __init__(self, bytes):
+        self.left = bytes
+        self.chunk = memoryview(b'')
+        # the random mode reuses one buffer for every chunk, made when
+        # the stream starts sending - not while it waits in a queue
+        self.buf = None
+
+    def __len__(self):
+        return self.left
+
+    def next_chunk(self):
+        if not self.chunk and self.left:
+            if POOL is None:
+                if self.buf is None:
+                    self.buf = memoryview(
+                        bytearray(min(self.left, CHUNK_SIZE)))
+                self.chunk = self.buf[:min(self.left, len(self.buf))]
+                view = self.chunk
+                while view:
+                    view = view[URANDOM.readinto(view):]
+            else:
+                # requests bigger than the pool get it several times over
+                self.chunk = POOL[:self.left]
+        return self.chunk
+
+    def consume(self, sent):
+        self.chunk = self.chunk[sent:]
+        self.left -= sent
+        if not self.left:
+            # a finished stream may still sit in a queue
+            self.buf = None
+
+    def send(self, sock):
+        """Send as much as the socket takes, returns number of bytes."""
+        sent = sock.send(self.next_chunk())
+        self.consume(sent)
+        return sent
+
+
+def send_response(sock, version, bytes):
+    """Send the whole response to the blocking socket, returns the number
+    of payload bytes."""
+    stream = Stream(bytes)
+    parts = [stream.next_chunk()]
+    if version != protocol.LEGACY:
+        # the header goes out together with the first chunk, no extra
+        # round trip because of Nagle's algorithm
+        parts.insert(0, protocol.pack_response_header(bytes))
+        # a pipelining client waits for the last small response of a
+        # burst, don't let Nagle's algorithm hold it for a delayed ACK
+        static.set_nodelay(sock)
+    protocol.sendall_parts(sock, parts)
+    stream.consume(len(parts[-1]))
+
+    while stream:
+        chunk = stream.next_chunk()
+        sock.sendall(chunk)
+        stream.consume(len(chunk))
+    return bytes
+
+
+def print_rss(who, rusage=None):
+    """Print the peak resident set size of this process or, given the
+    resource usage returned by 'os.wait4', of a terminated child."""
+    if rusage is None:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+    print('%s: max RSS %d KiB' % (who, rusage.ru_maxrss))
+
+
+def add_options(parser):
+    parser.add_option(
+        '--random', dest='random', action='store_true', default=False,
+        help='Generate new random bytes for every response')
+
+    parser.add_option(
+        '--pool-size', dest='pool_size', type='int', default=POOL_SIZE,
+        help=('Size of the shared payload pool in bytes. Default is %d'
+              % POOL_SIZE))
@@ -0,0 +1,190 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Pool sizing for the preforked servers, the way Apache's prefork MPM
+does it.
+
+The parent starts --child-num children and then, once a second, counts
+the idle ones: fewer than --min-spare and it forks more, up to
+--max-children in total; more than --max-spare and it retires one.
+Forking starts with one child a second and doubles every second the
+pool is still short of idle children, up to MAX_SPAWN_RATE, so a burst
+of connections doesn't turn into a fork storm.
+
+Children can also be recycled: replaced with a fresh one after
+--max-requests requests or once their peak RSS has grown by more than
+--max-rss-growth KiB since they started, so a slow leak never takes a
+child down.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import time
+import resource
+
+# how often the parent looks at the pool, in seconds
+INTERVAL = 1.0
+
+# max number of children forked in one interval
+MAX_SPAWN_RATE = 32
+
+# the default hard cap on the number of children
+MAX_CHILDREN = 256
+
+
+def peak_rss(pid=None):
+    """Returns the peak RSS in KiB of this process or of the child `pid`,
+    0 if it's gone."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class Periodic(object):
+    """Something the parent does every `interval` seconds."""
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.next_check = time.monotonic() + interval
+
+    def timeout(self):
+        """Seconds until the next check, for 'select'."""
+        return max(self.next_check - time.monotonic(), 0)
+
+    def due(self):
+        return time.monotonic() >= self.next_check
+
+    def checked(self):
+        self.next_check = time.monotonic() + self.interval
+
+
+class Sizer(Periodic):
+    """Tells the parent how many children to fork or retire."""
+
+    def __init__(self, min_spare, max_spare, max_children=MAX_CHILDREN,
+                 interval=INTERVAL):
+        super(Sizer, self).__init__(interval)
+        self.min_spare = min_spare
+        self.max_spare = max(max_spare, min_spare + 1)
+        self.max_children = max_children
+        self.spawn_rate = 1
+
+    def adjust(self, children, idle):
+        """Returns the number of children to fork, or to retire if it's
+        negative, given the number of `children` and `idle` ones."""
+        self.checked()
+
+        if idle > self.max_spare and children > 1:
+            self.spawn_rate = 1
+            # retire them one at a time, the load may come back
+            return -1
+
+        if idle < self.min_spare and children < self.max_children:
+            count = min(self.spawn_rate, self.min_spare - idle,
+                        self.max_children - children)
+            # still short next time - fork faster
+            self.spawn_rate = min(self.spawn_rate * 2, MAX_SPAWN_RATE)
+            return count
+
+        self.spawn_rate = 1
+        return 0
+
+
+class Recycler(Periodic):
+    """Tells when a child should be replaced with a fresh one."""
+
+    def __init__(self, max_requests=0, max_rss_growth=0, interval=INTERVAL):
+        super(Recycler, self).__init__(interval)
+        self.max_requests = max_requests
+        self.max_rss_growth = max_rss_growth
+
+    def start(self, requests, pid=None):
+        """Returns the starting point of a child, given the number of
+        requests its slot has counted so far."""
+        return requests, peak_rss(pid) if self.max_rss_growth else 0
+
+    def expired(self, start, requests, pid=None):
+        """Whether the child has done enough since `start`, given the
+        number of requests its slot has counted so far."""
+        start_requests, start_rss = start
+        if self.max_requests and requests - start_requests >= \
+                self.max_requests:
+            return True
+        if self.max_rss_growth:
+            return peak_rss(pid) - start_rss > self.max_rss_growth
+        return False
+
+
+def add_options(parser):
+    parser.add_option(
+        '--min-spare', dest='min_spare', type='int', default=0,
+        help=('Fork more children when fewer than that many are idle. '
+              'Default is 0, a fixed pool of --child-num children'))
+
+    parser.add_option(
+        '--max-spare', dest='max_spare', type='int', default=0,
+        help=('Retire children when more than that many are idle. '
+              'Default is --min-spare + --child-num'))
+
+    parser.add_option(
+        '--max-children', dest='max_children', type='int',
+        default=MAX_CHILDREN,
+        help=('Never run more children than that. Default is %d'
+              % MAX_CHILDREN))
+
+    parser.add_option(
+        '--max-requests', dest='max_requests', type='int', default=0,
+        help=('Replace a child after that many requests. '
+              'Default is 0, never'))
+
+    parser.add_option(
+        '--max-rss-growth', dest='max_rss_growth', type='int', default=0,
+        help=('Replace a child once its peak RSS grows by that many KiB. '
+              'Default is 0, never'))
+
+
+def create_sizer(options):
+    """Returns a Sizer for the command line options, None for a fixed
+    pool."""
+    if not options.min_spare and not options.max_spare:
+        return None
+    max_spare = options.max_spare or options.min_spare + options.childnum
+    return Sizer(options.min_spare, max_spare,
+                 max(options.max_children, options.childnum))
+
+
+def create_recycler(options):
+    """Returns a Recycler for the command line options, None if children
+    are never recycled."""
+    if not options.max_requests and not options.max_rss_growth:
+        return None
+    return Recycler(options.max_requests, options.max_rss_growth)
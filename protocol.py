@@ -0,0 +1,213 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Wire protocol shared by the servers and the client.
+
+Legacy (version 0) - the client sends the number of bytes it wants as
+ASCII digits, the server sends the bytes back and the client closes
+the connection. One request per connection.
+
+Framed (version 1) - every request and every response starts with
+a fixed-size header, so a connection can carry any number of requests
+and the client doesn't have to wait for a response before sending the
+next request (pipelining). Responses come back in the request order.
+
+    request:  version (1 byte), kind (1 byte), body length (2 bytes),
+              body
+    response: version (1 byte), status (1 byte), payload length
+              (8 bytes), payload
+
+All numbers are in network byte order. A BYTES request's body is the
+number of bytes wanted (8 bytes), a FILE request's body is the path of
+the file relative to the server's document root (UTF-8). An ERROR
+response's payload is the error message.
+
+A framed request never starts with an ASCII digit, which is how the
+servers tell the two versions apart.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import struct
+
+LEGACY, VERSION = 0, 1
+
+# request kinds
+BYTES, FILE = 1, 2
+
+# response status
+OK, ERROR = 0, 1
+
+REQUEST_HEADER = struct.Struct('!BBH')
+RESPONSE_HEADER = struct.Struct('!BBQ')
+BYTES_BODY = struct.Struct('!Q')
+
+DIGITS = b'0123456789'
+
+# max number of buffers passed to a single 'sendmsg'
+IOV_MAX = 64
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_legacy(data):
+    return bool(data) and data[0] in DIGITS
+
+
+def pack_request(bytes):
+    return REQUEST_HEADER.pack(VERSION, BYTES, BYTES_BODY.size) + \
+        BYTES_BODY.pack(bytes)
+
+
+def pack_file_request(path):
+    body = path.encode('utf-8')
+    return REQUEST_HEADER.pack(VERSION, FILE, len(body)) + body
+
+
+def pack_response_header(length, status=OK):
+    return RESPONSE_HEADER.pack(VERSION, status, length)
+
+
+def unpack_response_header(data):
+    """Returns (status, payload length)."""
+    version, status, length = RESPONSE_HEADER.unpack(data)
+    if version != VERSION:
+        raise ProtocolError('Unsupported protocol version %d' % version)
+    return status, length
+
+
+class RequestParser(object):
+    """Incremental request parser.
+
+    Data is read straight into a buffer that is reused for the whole
+    life of the connection; complete requests are parsed in place.
+    Iterating over the parser yields (version, kind, argument) for every
+    complete request in the buffer; the argument is the number of bytes
+    for BYTES requests and the path for FILE requests.
+    """
+
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        # unparsed data is buf[start:end]
+        self.start = self.end = 0
+        # None until the first byte tells us the version
+        self.version = None
+
+    def _make_room(self, size):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < size:
+            # move the unparsed tail to the front
+            tail = self.end - self.start
+            self.buf[:tail] = self.buf[self.start:self.end]
+            self.start, self.end = 0, tail
+        if len(self.buf) - self.end < size:
+            self.buf.extend(bytearray(size - (len(self.buf) - self.end)))
+
+    def recv_into(self, sock, size=4096):
+        """Read from the socket into the buffer, returns number of bytes."""
+        self._make_room(size)
+        nbytes = sock.recv_into(memoryview(self.buf)[self.end:])
+        self.end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        self._make_room(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def __iter__(self):
+        while self.start < self.end:
+            if self.version is None:
+                self.version = LEGACY if is_legacy(
+                    self.buf[self.start:self.start + 1]) else VERSION
+
+            if self.version == LEGACY:
+                # no framing - whatever has arrived is the whole request
+                data = bytes(self.buf[self.start:self.end])
+                self.start = self.end
+                yield LEGACY, BYTES, int(data)
+                continue
+
+            if self.end - self.start < REQUEST_HEADER.size:
+                return
+            version, kind, length = REQUEST_HEADER.unpack_from(
+                self.buf, self.start)
+            if version != VERSION:
+                raise ProtocolError('Unsupported protocol version %d' % version)
+            if self.end - self.start < REQUEST_HEADER.size + length:
+                return
+
+            body = self.start + REQUEST_HEADER.size
+            self.start = body + length
+            if kind == BYTES and length == BYTES_BODY.size:
+                yield VERSION, BYTES, BYTES_BODY.unpack_from(self.buf, body)[0]
+            elif kind == FILE:
+                try:
+                    path = self.buf[body:body + length].decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ProtocolError('File path is not valid UTF-8')
+                yield VERSION, FILE, path
+            else:
+                raise ProtocolError('Unsupported request kind %d' % kind)
+
+
+def read_requests(sock):
+    """Yields (version, kind, argument) for every request from the socket.
+
+    A legacy connection carries one request, a framed one goes on
+    until the client closes it.
+    """
+    parser = RequestParser()
+    while parser.recv_into(sock):
+        for request in parser:
+            yield request
+        if parser.version == LEGACY:
+            return
+
+
+def sendall_parts(sock, parts):
+    """Like 'sendall' for several buffers, without joining them first."""
+    parts = [memoryview(part) for part in parts if len(part)]
+    while parts:
+        sent = sock.sendmsg(parts[:IOV_MAX])
+        while sent:
+            if sent >= len(parts[0]):
+                sent -= len(parts.pop(0))
+            else:
+                parts[0] = parts[0][sent:]
+                sent = 0
+
+
+def pack_error(message):
+    """Returns the whole ERROR response."""
+    data = message.encode('utf-8')
+    return pack_response_header(len(data), ERROR) + data
+
+
+def send_error(sock, message):
+    sock.sendall(pack_error(message))
@@ -37,17 +37,28 @@ import signal
 import socket
 import optparse
 
-BACKLOG = 5
+import payload
+import static
+import listener
+import protocol
+
+# the biggest peak RSS among terminated children and their number
+CHILD_RSS = None
+CHILDREN_DONE = 0
 
 
 def _reap_children(signum, frame):
     """Collect zombie children."""
+    global CHILD_RSS, CHILDREN_DONE
     while True:
         try:
             # wait for all children, do not block
-            pid, status = os.waitpid(-1, os.WNOHANG)
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
             if pid == 0: # no more zombies
                 break
+            CHILDREN_DONE += 1
+            if CHILD_RSS is None or rusage.ru_maxrss > CHILD_RSS.ru_maxrss:
+                CHILD_RSS = rusage
         except:
             # Usually this would be OSError exception
             # with 'errno' attribute set to errno.ECHILD
@@ -56,17 +67,21 @@ def _reap_children(signum, frame):
 
 
 def handle(sock):
-    # read a line that tells us how many bytes to write
-    bytes = int(sock.recv(1024))
-    # get our random bytes
-    data = os.urandom(bytes)
+    # read requests until the client closes the connection,
+    # a legacy client sends only one
+    for version, kind, arg in protocol.read_requests(sock):
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            static.send_file(sock, version, arg)
+            continue
 
-    print('Got request to send %d bytes. Sending them all...' % bytes)
-    # send them all
-    sock.sendall(data)
+        bytes = arg
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        # send them all, chunk by chunk
+        payload.send_response(sock, version, bytes)
 
 
-def serve_forever(host, port):
+def serve_forever(host, port, backlog=listener.BACKLOG):
     # setup SIGCHLD handler
     signal.signal(signal.SIGCHLD, _reap_children)
 
@@ -76,14 +91,22 @@ def serve_forever(host, port):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     sock.bind((host, port))
-    sock.listen(BACKLOG)
+    listener.listen(sock, backlog)
 
     print('Listening on port %d ...' % port)
 
     # spawn a new child process for every request
     while True:
         try:
-            conn, client_address = sock.accept()
+            conn = listener.accept(sock, blocking=True)
+        except KeyboardInterrupt:
+            print()
+            listener.print_overflows()
+            payload.print_rss('parent')
+            if CHILD_RSS is not None:
+                payload.print_rss(
+                    'largest of %d children' % CHILDREN_DONE, CHILD_RSS)
+            return
         except IOError as e:
             code, msg = e.args
             if code == errno.EINTR:
@@ -95,7 +118,11 @@ def serve_forever(host, port):
         if pid == 0: # child
             # close listening socket
             sock.close()
-            handle(conn)
+            try:
+                handle(conn)
+            except (OSError, ValueError, protocol.ProtocolError):
+                # the client went away or sent garbage
+                pass
             os._exit(0)
 
         # parent - close connected socket
@@ -113,9 +140,18 @@ def main():
         '-p', '--port', dest='port', type='int', default=2000,
         help='Port. Default is 2000')
 
+    payload.add_options(parser)
+    static.add_options(parser)
+    # one blocking 'accept' per fork, nothing to batch
+    listener.add_options(parser, batch=False)
+
     options, args = parser.parse_args()
 
-    serve_forever(options.host, options.port)
+    # before forking, children share the pool
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    serve_forever(options.host, options.port, options.backlog)
 
 if __name__ == '__main__':
     main()
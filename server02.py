@@ -23,24 +23,308 @@
 ###############################################################################
 
 """
-TCP Concurrent Server, I/O Multiplexing (select).
+TCP Concurrent Server, I/O Multiplexing (select, poll, epoll).
 
 Single server process to handle any number of clients.
+
+Responses are queued per connection and written out only when the
+multiplexer reports the socket as writable, so one slow client can't
+stall the rest.
+
+The multiplexer is picked with --multiplexer; all of them sit behind
+the same small interface so the event loop is identical for each one.
 """
 
 __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
 
-import os
 import sys
+import time
 import errno
 import select
 import socket
 import optparse
+import resource
+import selectors
+import itertools
+import collections
+
+import static
+import payload
+import listener
+import protocol
+
+# stop reading from a client once that many bytes are queued for it
+HIGH_WATER = 64 * 1024
+
+# maps a connected socket to a queue of memoryviews, payload streams
+# (payload.Stream) and files (static.OpenFile) waiting to be sent
+OUTQUEUES = {}
+
+# maps a connected socket to its request parser
+PARSERS = {}
+
+
+def enqueue(sock, data):
+    if not isinstance(data, (static.OpenFile, payload.Stream)):
+        data = memoryview(data)
+    if not len(data):
+        # nothing to send, an empty file can be released right away
+        if _is_file(data):
+            data.close()
+        return
+    OUTQUEUES.setdefault(sock, collections.deque()).append(data)
+
+
+def _is_file(item):
+    return isinstance(item, static.OpenFile)
+
+
+def _gather(queue):
+    """Returns buffers to send with one 'sendmsg' and its flags."""
+    views = []
+    for item in itertools.islice(queue, protocol.IOV_MAX):
+        if _is_file(item):
+            # a file follows - don't push the header out on its own
+            return views, socket.MSG_MORE
+        if isinstance(item, payload.Stream):
+            chunk = item.next_chunk()
+            views.append(chunk)
+            if len(chunk) < len(item):
+                # the next chunk is made once this one is sent
+                break
+        else:
+            views.append(item)
+    return views, 0
+
+
+def queued_bytes(sock):
+    return sum(len(view) for view in OUTQUEUES.get(sock, ()))
+
+
+def drain(sock):
+    """Send as much of the queued output as the socket accepts.
+
+    Returns False if the connection is broken.
+    """
+    queue = OUTQUEUES[sock]
+    while queue:
+        head = queue[0]
+        try:
+            if _is_file(head):
+                # the kernel copies the file straight to the socket
+                sent = head.send(sock)
+            else:
+                # gather several buffers (e.g. response header and payload)
+                # into one system call, up to the next file
+                views, flags = _gather(queue)
+                sent = sock.sendmsg(views, [], flags)
+        except IOError as e:
+            code, msg = e.args
+            if code == errno.EINTR:
+                continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            elif code in (errno.EPIPE, errno.ECONNRESET):
+                return False
+            else:
+                raise
+
+        if _is_file(head):
+            if not sent: # the file got shorter
+                return False
+            if len(head):
+                # partial write - resume when the socket is writable
+                break
+            queue.popleft().close()
+            continue
+
+        partial = sent < sum(len(view) for view in views)
+        while sent:
+            head = queue[0]
+            if isinstance(head, payload.Stream):
+                count = min(sent, len(head.chunk))
+                head.consume(count)
+                sent -= count
+                if not len(head):
+                    queue.popleft()
+            elif sent >= len(head):
+                sent -= len(queue.popleft())
+            else:
+                # keep the rest without copying
+                queue[0] = head[sent:]
+                sent = 0
+        if partial:
+            # resume when the socket is writable
+            break
+
+    if not queue:
+        del OUTQUEUES[sock]
+    return True
+
+
+READ, WRITE = selectors.EVENT_READ, selectors.EVENT_WRITE
+
+
+class SelectPoller(object):
+    """select(2) - rescans every descriptor, limited to FD_SETSIZE."""
+
+    def __init__(self):
+        self.rlist, self.wlist = [], []
+        self.socks = {}
+
+    def register(self, sock, events):
+        self.socks[sock.fileno()] = sock
+        self.modify(sock, events)
+
+    def modify(self, sock, events):
+        for lst, event in ((self.rlist, READ), (self.wlist, WRITE)):
+            if events & event:
+                if sock not in lst:
+                    lst.append(sock)
+            elif sock in lst:
+                lst.remove(sock)
+
+    def unregister(self, sock):
+        self.modify(sock, 0)
+        del self.socks[sock.fileno()]
+
+    def poll(self, timeout=None):
+        readables, writables, _ = select.select(
+            self.rlist, self.wlist, [], timeout)
+        ready = dict.fromkeys(readables, READ)
+        for sock in writables:
+            ready[sock] = ready.get(sock, 0) | WRITE
+        return list(ready.items())
+
+
+class PollPoller(object):
+    """poll(2) - no FD_SETSIZE limit, but still O(n) per call."""
+
+    FLAGS = {
+        READ: select.POLLIN | select.POLLPRI,
+        WRITE: select.POLLOUT,
+        }
+    # hangups and errors are reported as readable,
+    # the following 'recv' tells what exactly happened
+    READ_MASK = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+    def __init__(self):
+        self.poller = select.poll()
+        self.socks = {}
+
+    def _mask(self, events):
+        return sum(flag for event, flag in self.FLAGS.items() if events & event)
+
+    def register(self, sock, events):
+        self.socks[sock.fileno()] = sock
+        self.poller.register(sock, self._mask(events))
+
+    def modify(self, sock, events):
+        self.poller.modify(sock, self._mask(events))
+
+    def unregister(self, sock):
+        self.poller.unregister(sock)
+        del self.socks[sock.fileno()]
+
+    def poll(self, timeout=None):
+        # poll's timeout is in milliseconds
+        if timeout is not None:
+            timeout *= 1000
+        ready = []
+        for fd, flags in self.poller.poll(timeout):
+            events = 0
+            if flags & self.READ_MASK:
+                events |= READ
+            if flags & select.POLLOUT:
+                events |= WRITE
+            ready.append((self.socks[fd], events))
+        return ready
 
-BACKLOG = 5
 
+if hasattr(select, 'epoll'):
+    class EpollPoller(PollPoller):
+        """epoll(7), level-triggered - returns only ready descriptors."""
+
+        FLAGS = {
+            READ: select.EPOLLIN | select.EPOLLPRI,
+            WRITE: select.EPOLLOUT,
+            }
+        READ_MASK = (select.EPOLLIN | select.EPOLLPRI |
+                     select.EPOLLHUP | select.EPOLLERR)
+
+        def __init__(self):
+            self.poller = select.epoll()
+            self.socks = {}
+
+        def poll(self, timeout=None):
+            ready = []
+            for fd, flags in self.poller.poll(-1 if timeout is None else timeout):
+                events = 0
+                if flags & self.READ_MASK:
+                    events |= READ
+                if flags & select.EPOLLOUT:
+                    events |= WRITE
+                ready.append((self.socks[fd], events))
+            return ready
+
+
+class SelectorsPoller(object):
+    """selectors.DefaultSelector - the best mechanism for the platform."""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, sock, events):
+        self.selector.register(sock, events)
+
+    def modify(self, sock, events):
+        self.selector.modify(sock, events)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+
+    @property
+    def socks(self):
+        return self.selector.get_map()
+
+    def poll(self, timeout=None):
+        return [(key.fileobj, events)
+                for key, events in self.selector.select(timeout)]
+
+
+MULTIPLEXERS = {
+    'select': SelectPoller,
+    'poll': PollPoller,
+    'selectors': SelectorsPoller,
+    }
+if hasattr(select, 'epoll'):
+    MULTIPLEXERS['epoll'] = EpollPoller
+
+
+def _raise_nofile_limit():
+    """Allow as many descriptors as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def print_stats(poller, stats):
+    iterations = stats['iterations'] or 1
+    print('fds: %d, iterations: %d, events: %.1f/iter, '
+          'poll: %.1f us/iter, loop: %.1f us/iter' % (
+              len(poller.socks), stats['iterations'],
+              stats['events'] / iterations,
+              stats['poll_time'] / iterations * 1e6,
+              stats['loop_time'] / iterations * 1e6))
+    stats.update(iterations=0, events=0, poll_time=0.0, loop_time=0.0)
+
+
+def serve_forever(host, port, high_water=HIGH_WATER,
+                  multiplexer='select', stats_interval=0,
+                  backlog=listener.BACKLOG,
+                  accept_batch=listener.ACCEPT_BATCH):
+    _raise_nofile_limit()
 
-def serve_forever(host, port):
     # create, bind. listen
     lstsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # re-use the port
@@ -49,44 +333,122 @@ def serve_forever(host, port):
     lstsock.setblocking(0)
 
     lstsock.bind((host, port))
-    lstsock.listen(BACKLOG)
+    listener.listen(lstsock, backlog)
+
+    print('Listening on port %d (%s) ...' % (port, multiplexer))
 
-    print('Listening on port %d ...' % port)
+    poller = MULTIPLEXERS[multiplexer]()
+    poller.register(lstsock, READ)
 
-    # read, write, exception lists with sockets to poll
-    rlist, wlist, elist = [lstsock], [], []
+    # time spent in the multiplexer vs the whole loop iteration;
+    # under load the wait is short and the poll time is mostly the cost
+    # of the system call itself
+    stats = dict(iterations=0, events=0, poll_time=0.0, loop_time=0.0)
+    next_report = time.monotonic() + stats_interval
+    timeout = stats_interval or None
+
+    def close(sock):
+        for item in OUTQUEUES.pop(sock, ()):
+            if _is_file(item):
+                item.close()
+        PARSERS.pop(sock, None)
+        poller.unregister(sock)
+        sock.close()
 
     while True:
-        # block in select
-        readables, writables, exceptions = select.select(rlist, wlist, elist)
+        # block in the multiplexer
+        started = time.perf_counter()
+        try:
+            ready = poller.poll(timeout)
+        except InterruptedError:
+            continue
+        polled = time.perf_counter()
+
+        for sock, events in ready:
+            if sock is lstsock: # new client connection(s), we can accept now
+                # never let a slow client block the whole loop,
+                # connections come out non-blocking
+                for conn in listener.accept_batch(lstsock, accept_batch):
+                    # watch the new connection for requests
+                    # in the next loop cycle
+                    poller.register(conn, READ)
+                    PARSERS[conn] = protocol.RequestParser()
+                continue
 
-        for sock in readables:
-            if sock is lstsock: # new client connection, we can accept now
+            if events & READ:
+                # read requests, a framed client may send several at once
+                parser = PARSERS[sock]
                 try:
-                    conn, client_address = lstsock.accept()
+                    nbytes = parser.recv_into(sock)
                 except IOError as e:
                     code, msg = e.args
-                    if code == errno.EINTR:
+                    if code in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                        nbytes = None
+                    elif code == errno.ECONNRESET:
+                        close(sock)
                         continue
                     else:
                         raise
-                # add the new connection to the 'read' list to poll
-                # in the next loop cycle
-                rlist.append(conn)
-            else:
-                # read a line that tells us how many bytes to write
-                bytes = sock.recv(1024)
-                if not bytes: # connection closed by client
-                    sock.close()
-                    rlist.remove(sock)
-                else:
-                    print ('Got request to send %s bytes. '
-                           'Sending them all...' % bytes)
-                    # send them all
-                    # XXX: this is cheating, we should use 'select' and wlist
-                    # to determine whether socket is ready to be written to
-                    data = os.urandom(int(bytes))
-                    sock.sendall(data)
+
+                if nbytes == 0: # connection closed by client
+                    close(sock)
+                    continue
+
+                try:
+                    for version, kind, arg in parser:
+                        if kind == protocol.FILE:
+                            print ('Got request to send file %s. '
+                                   'Queueing it up...' % arg)
+                            response = static.open_file(arg)
+                            if isinstance(response, str): # error message
+                                enqueue(sock, protocol.pack_error(response))
+                            else:
+                                static.set_nodelay(sock)
+                                enqueue(sock, protocol.pack_response_header(
+                                    len(response)))
+                                enqueue(sock, response)
+                            continue
+
+                        bytes = arg
+                        print ('Got request to send %d bytes. '
+                               'Queueing them up...' % bytes)
+                        if version != protocol.LEGACY:
+                            enqueue(sock, protocol.pack_response_header(bytes))
+                        # produced chunk by chunk as the socket takes it
+                        enqueue(sock, payload.Stream(bytes))
+                except (ValueError, protocol.ProtocolError):
+                    close(sock)
+                    continue
+
+                if sock in OUTQUEUES:
+                    # the data will go out when the multiplexer says the
+                    # socket is ready to be written to; if the client is
+                    # not keeping up with us - stop reading its requests
+                    # until its output queue drains
+                    if queued_bytes(sock) >= high_water:
+                        poller.modify(sock, WRITE)
+                    else:
+                        poller.modify(sock, READ | WRITE)
+
+            if events & WRITE and sock in OUTQUEUES:
+                if not drain(sock):
+                    close(sock)
+                    continue
+
+                if sock not in OUTQUEUES: # queue drained
+                    # nothing to write, resume reading requests
+                    poller.modify(sock, READ)
+
+        if stats_interval:
+            if ready: # timeouts only measure how long we were idle
+                now = time.perf_counter()
+                stats['iterations'] += 1
+                stats['events'] += len(ready)
+                stats['poll_time'] += polled - started
+                stats['loop_time'] += now - started
+            if time.monotonic() >= next_report:
+                print_stats(poller, stats)
+                next_report = time.monotonic() + stats_interval
 
 
 def main():
@@ -100,9 +462,40 @@ def main():
         '-p', '--port', dest='port', type='int', default=2000,
         help='Port. Default is 2000')
 
+    parser.add_option(
+        '-w', '--high-water', dest='high_water', type='int',
+        default=HIGH_WATER,
+        help=('Stop reading from a client when that many bytes are queued '
+              'for it. Default is %d' % HIGH_WATER))
+
+    parser.add_option(
+        '-m', '--multiplexer', dest='multiplexer', default='select',
+        choices=sorted(MULTIPLEXERS),
+        help='One of: %s. Default is select' % ', '.join(sorted(MULTIPLEXERS)))
+
+    parser.add_option(
+        '-s', '--stats', dest='stats', type='float', default=0,
+        help=('Print per-iteration multiplexer and loop time every '
+              'STATS seconds. Default is 0 (off)'))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    listener.add_options(parser)
+
     options, args = parser.parse_args()
 
-    serve_forever(options.host, options.port)
+    # filled once at startup
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    try:
+        serve_forever(options.host, options.port, options.high_water,
+                      options.multiplexer, options.stats, options.backlog,
+                      options.accept_batch)
+    except KeyboardInterrupt:
+        print()
+        listener.print_overflows()
+        payload.print_rss('server')
 
 if __name__ == '__main__':
     main()
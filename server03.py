@@ -26,67 +26,276 @@
 TCP Preforked Server, Children Call 'accept'
 
 Pool of child processes handle client requests.
+
+With --reuseport every child gets its own listening socket bound to the
+same port with SO_REUSEPORT. The kernel then hashes new connections
+across the per-child accept queues instead of waking all children
+blocked on a single socket.
+
+--accept picks how children wait for connections:
+
+    accept         - all children block in 'accept' (the default)
+    mutex          - only the child holding an fcntl lock blocks in
+                     'accept', the rest wait for the lock (like Apache)
+    epoll          - every child waits in its own 'epoll' instance,
+                     all of them wake up on a new connection
+    epollexclusive - the same with EPOLLEXCLUSIVE, the kernel wakes
+                     up only one of them
+
+Every child counts its connections, requests, bytes, errors and latency
+in a shared stats slab (see stats.py); with --metrics the parent serves
+them as a plain-text report (see metrics.py).
+
+With --min-spare/--max-spare the pool grows and shrinks with the load
+(see pool.py): the parent counts the idle children in the slab, forks
+more or asks an idle one to leave with SIGTERM. A child that gets
+SIGTERM while handling a connection finishes it first.
+
+The parent reaps children on SIGCHLD and forks a replacement for every
+one that dies, while the others go on accepting. With --max-requests or
+--max-rss-growth a child exits between connections once it has served
+enough or grown too much, and is replaced the same way.
+
+SIGHUP or SIGUSR2 restarts the server without refusing a connection:
+the parent starts a new one and hands it the listening sockets (see
+handover.py), then its children finish their connections and exit.
+
+By default there's a child per available CPU. --pin binds every child
+to one of them (--cpus narrows the set, see affinity.py); with
+--reuseport the kernel then prefers the child on the CPU that processed
+the connection's packets (SO_INCOMING_CPU).
 """
 
 __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
 
 
 import os
+import sys
+import time
+import fcntl
 import errno
+import select
 import signal
 import socket
 import optparse
+import tempfile
+
+import pool
+import stats
+import affinity
+import handover
+import metrics
+import payload
+import static
+import listener
+import protocol
+
+# stores pids of all preforked children, None for an empty slot
+PIDS = []
 
-BACKLOG = 5
+# pids of children asked to exit and not reaped yet
+RETIRING = set()
 
-# stores pids of all preforked children
-PIDS = []
+# per-child listening sockets in the SO_REUSEPORT mode
+LISTENERS = []
 
+ACCEPT_STRATEGIES = ['accept', 'mutex', 'epoll', 'epollexclusive']
+# how children wait for new connections, one of ACCEPT_STRATEGIES
+STRATEGY = 'accept'
 
-def handle(sock):
-    # read a line that tells us how many bytes to write back
-    bytes = int(sock.recv(1024))
-    # get our random bytes
-    data = os.urandom(bytes)
+# file all children lock in the 'mutex' strategy
+LOCK_FILE = None
 
-    print('Got request to send %d bytes. Sending them all...' % bytes)
-    # send them all
-    sock.sendall(data)
+# shared stats slab, a slot and a latency histogram for every child
+STATS = None
 
+# serves the metrics, if asked to
+REPORTER = None
 
-def child_loop(index, listen_sock):
-    """Main child loop."""
+# tells children when to make room for a fresh one, if asked to
+RECYCLER = None
+
+# which CPUs children run on, if not left to the scheduler
+PLACEMENT = None
+
+# the SIGCHLD handler wakes up the parent through this pipe
+WAKEUP_RD, WAKEUP_WR = None, None
+
+# in a child: set while it waits for a connection and can simply exit,
+# and once the parent has asked it to exit
+WAITING, RETIRED = False, False
+# in a child: the socket it accepts connections on
+LISTEN_SOCK = None
+
+
+def handle(sock, slot):
+    # read requests until the client closes the connection,
+    # a legacy client sends only one
+    for version, kind, arg in protocol.read_requests(sock):
+        slot.add(stats.REQUESTS)
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            slot.add(stats.BYTES_SENT, static.send_file(sock, version, arg))
+            continue
+
+        bytes = arg
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        # send them all, chunk by chunk
+        slot.add(stats.BYTES_SENT,
+                 payload.send_response(sock, version, bytes))
+
+
+def accept(slot, listen_sock):
+    """Returns a new connection or None if another child got it."""
     while True:
-        # block waiting for connection to handle
         try:
-            conn, client_address = listen_sock.accept()
+            # the listening socket may be non-blocking, the connection isn't
+            conn = listener.accept(listen_sock, blocking=True)
         except IOError as e:
             code, msg = e.args
             if code == errno.EINTR:
                 continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # woke up for nothing
+                slot.add(stats.EAGAINS)
+                return None
+            elif code == errno.EBADF and RETIRED:
+                # '_retire' closed the listening socket under us
+                return None
             else:
                 raise
+        return conn
 
-        handle(conn)
+
+def child_loop(index, listen_sock):
+    """Main child loop."""
+    slot = STATS.slot(index)
+    if RECYCLER is not None:
+        born = RECYCLER.start(slot.get(stats.REQUESTS))
+    if STRATEGY in ('epoll', 'epollexclusive'):
+        # every child needs its own epoll instance
+        epoll = select.epoll()
+        flags = select.EPOLLIN
+        if STRATEGY == 'epollexclusive':
+            flags |= select.EPOLLEXCLUSIVE
+        epoll.register(listen_sock.fileno(), flags)
+
+    global WAITING
+    while True:
+        if RETIRED:
+            os._exit(0)
+        # block waiting for connection to handle
+        if STRATEGY == 'mutex':
+            # only one child at a time waits in 'accept'
+            WAITING = True
+            fcntl.lockf(LOCK_FILE, fcntl.LOCK_EX)
+            WAITING = False
+            try:
+                conn = accept(slot, listen_sock)
+            finally:
+                fcntl.lockf(LOCK_FILE, fcntl.LOCK_UN)
+        elif STRATEGY in ('epoll', 'epollexclusive'):
+            WAITING = True
+            epoll.poll()
+            WAITING = False
+            conn = accept(slot, listen_sock)
+        else:
+            conn = accept(slot, listen_sock)
+
+        # the process woke up - update the counters
+        slot.add(stats.WAKEUPS)
+        if conn is None:
+            continue
+        slot.add(stats.ACCEPTS)
+
+        start = time.monotonic_ns()
+        try:
+            handle(conn, slot)
+        except (OSError, ValueError, protocol.ProtocolError):
+            # the client went away or sent garbage, count it and take
+            # the next one
+            slot.add(stats.ERRORS)
 
         # close handled socket connection and off to handle another request
         conn.close()
 
+        elapsed = time.monotonic_ns() - start
+        slot.add(stats.BUSY_NS, elapsed)
+        slot.record_latency(elapsed)
+        slot.add(stats.HANDLED)
+
+        if RETIRED:
+            os._exit(0)
+        if (RECYCLER is not None and
+                RECYCLER.expired(born, slot.get(stats.REQUESTS))):
+            print('Child %d (PID: %s) is recycled' % (index, os.getpid()))
+            os._exit(0)
+
+
+def _retire(signum, frame):
+    """SIGTERM signal handler in a child: exit right away if it hasn't
+    started accepting yet, else once the connection in hand is handled.
+
+    A connection 'accept' has already returned can't be put back, so
+    instead of exiting the child closes its listening socket: a blocked
+    'accept' then fails with EBADF and the rest of the queue is left to
+    the other processes sharing the socket.
+    """
+    global RETIRED
+    if WAITING:
+        os._exit(0)
+    RETIRED = True
+    LISTEN_SOCK.close()
+
 
 def create_child(index, listen_sock):
-    pid = os.fork()
+    # until the child has its own SIGTERM handler a SIGTERM from
+    # 'maintain_pool' or the recycler waits, the parent's '_cleanup'
+    # would kill the child's siblings
+    mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+    try:
+        pid = os.fork()
+    except OSError:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        raise
     if pid > 0: # parent
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
         return pid
 
     print('Child started with PID: %s' % os.getpid())
+    if PLACEMENT is not None:
+        PLACEMENT.apply(index)
+    # close listening sockets that belong to other children
+    for sock in LISTENERS:
+        if sock is not listen_sock:
+            sock.close()
+    # a respawned child inherits the parent's signal plumbing
+    if WAKEUP_WR is not None:
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGCHLD,) + handover.SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        os.close(WAKEUP_RD)
+        os.close(WAKEUP_WR)
+    if REPORTER is not None:
+        REPORTER.sock.close()
+    # a child forked later inherits the parent's SIGTERM handler too
+    global LISTEN_SOCK
+    LISTEN_SOCK = listen_sock
+    signal.signal(signal.SIGTERM, _retire)
+    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
     # child never returns
-    child_loop(index, listen_sock)
+    try:
+        child_loop(index, listen_sock)
+    except KeyboardInterrupt:
+        os._exit(0)
 
 
 def _cleanup(signum, frame):
     """SIGTERM signal handler"""
     # terminate all children
     for pid in PIDS:
+        if pid is None:
+            continue
         try:
             os.kill(pid, signal.SIGTERM)
         except:
@@ -95,7 +304,7 @@ def _cleanup(signum, frame):
     # wait for all children to finish
     while True:
         try:
-            pid, status = os.wait()
+            pid, status, rusage = os.wait4(-1, 0)
         except OSError as e:
             if e.errno == errno.ECHILD:
                 break
@@ -104,31 +313,229 @@ def _cleanup(signum, frame):
 
         if pid == 0:
             break
+        payload.print_rss('child PID %s' % pid, rusage)
 
     os._exit(0)
 
 
-def serve_forever(host, port, childnum):
-    # create, bind, listen
-    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # re-use the port
-    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def create_listen_sock(host, port, reuseport=False, listen_sock=None,
+                       backlog=listener.BACKLOG):
+    """Returns a new listening socket or `listen_sock`, taken over from
+    the old master, set up for the accept strategy."""
+    if listen_sock is None:
+        # create, bind, listen
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # re-use the port
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            # let several sockets listen on the same port,
+            # each one gets its own accept queue
+            listen_sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        listen_sock.bind((host, port))
+    listener.listen(listen_sock, backlog)
+
+    # children wait in 'epoll', 'accept' must not block
+    # when another child has already taken the connection
+    listen_sock.setblocking(STRATEGY not in ('epoll', 'epollexclusive'))
+    return listen_sock
+
 
-    listen_sock.bind((host, port))
-    listen_sock.listen(BACKLOG)
+def in_flight(index):
+    """Number of connections the child has accepted and not handled yet"""
+    return STATS.get(index, stats.ACCEPTS) - STATS.get(index, stats.HANDLED)
+
+
+def reap_children():
+    """Replace children that exited, unless they were retired."""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+        if pid not in PIDS:
+            continue
+
+        index = PIDS.index(pid)
+        PIDS[index] = None
+        if pid in RETIRING:
+            RETIRING.remove(pid)
+            continue
+
+        lost = in_flight(index)
+        if lost:
+            # the child died with a connection, it's not coming back;
+            # nobody writes to the slot until the next child starts
+            slot = STATS.slot(index)
+            slot.add(stats.ERRORS, lost)
+            slot.add(stats.HANDLED, lost)
+
+        print('Child %d (PID: %s) terminated, starting a new one' % (
+            index, pid))
+        # the parent keeps the listening socket open, so connections
+        # queued on it are not lost; with --reuseport the other
+        # children's queues are not touched at all
+        PIDS[index] = create_child(index, LISTENERS[index])
+
+
+def maintain_pool(sizer):
+    """Fork or retire children to keep the number of idle ones between
+    the sizer's limits."""
+    live = [index for index, pid in enumerate(PIDS)
+            if pid is not None and pid not in RETIRING]
+    idle = [index for index in live if not in_flight(index)]
+
+    count = sizer.adjust(len(live), len(idle))
+    if count < 0:
+        index = idle[-1]
+        print('Retiring child %d (PID: %s)' % (index, PIDS[index]))
+        RETIRING.add(PIDS[index])
+        os.kill(PIDS[index], signal.SIGTERM)
+
+    # a retired child's slot is free once it's reaped, one still
+    # finishing its connection keeps it taken
+    for _ in range(min(count, PIDS.count(None))):
+        index = PIDS.index(None)
+        PIDS[index] = create_child(index, LISTENERS[index])
+
+
+def _wake_up(signum, frame):
+    """SIGCHLD signal handler, 'signal.set_wakeup_fd' does the work"""
+
+
+def upgrade():
+    """Hand the sockets over to a new master, let the children finish
+    their connections and exit."""
+    socks = []
+    for listen_sock in LISTENERS:
+        if ('listen', listen_sock) not in socks:
+            socks.append(('listen', listen_sock))
+    if REPORTER is not None:
+        socks.append(('metrics', REPORTER.sock))
+    if not handover.start_successor(socks):
+        return
+
+    # the new master accepts from now on
+    pids = [pid for pid in PIDS if pid is not None]
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
+    handover.drain(pids)
+    print('Old master (PID: %s) is done' % os.getpid())
+    sys.exit(0)
+
+
+def parent_forever(sizer=None):
+    """Replace dead children, serve metrics and with a `sizer` keep the
+    pool size in line with the load."""
+    # parent never calls 'accept' - children do all the work
+    # all parent does is looking after them :)
+
+    # the self-pipe trick: the signal wakes up 'select'
+    global WAKEUP_RD, WAKEUP_WR
+    WAKEUP_RD, WAKEUP_WR = os.pipe()
+    os.set_blocking(WAKEUP_RD, False)
+    os.set_blocking(WAKEUP_WR, False)
+    signal.set_wakeup_fd(WAKEUP_WR)
+    for signum in (signal.SIGCHLD,) + handover.SIGNALS:
+        signal.signal(signum, _wake_up)
+    # children that died before the handler was there
+    reap_children()
+    # if it's a restart, the old master can go
+    handover.ready()
+
+    rlist = [WAKEUP_RD]
+    if REPORTER is not None:
+        rlist.append(REPORTER)
+
+    while True:
+        timeout = sizer.timeout() if sizer is not None else None
+        readables, writables, exceptions = select.select(
+            rlist, [], [], timeout)
+
+        if WAKEUP_RD in readables:
+            try:
+                # the numbers of the signals that arrived
+                signums = os.read(WAKEUP_RD, 4096)
+            except BlockingIOError:
+                signums = b''
+            reap_children()
+            if any(signum in handover.SIGNALS for signum in signums):
+                upgrade()
+
+        if REPORTER in readables:
+            REPORTER.serve([in_flight(index)
+                            for index, pid in enumerate(PIDS)
+                            if pid is not None and pid not in RETIRING])
+
+        if sizer is not None and sizer.due():
+            maintain_pool(sizer)
+
+
+def serve_forever(host, port, childnum, reuseport=False, strategy='accept',
+                  metrics_address=None, sizer=None, recycler=None,
+                  backlog=listener.BACKLOG, placement=None):
+    global LISTENERS, PIDS, STRATEGY, LOCK_FILE, STATS, REPORTER, RECYCLER
+    global PLACEMENT
+    STRATEGY = strategy
+    RECYCLER = recycler
+    PLACEMENT = placement
+    if strategy == 'mutex':
+        # opened before forking, all children lock the same file
+        LOCK_FILE = tempfile.TemporaryFile()
+
+    # sockets of the old master if it's a restart
+    inherited = handover.inherit()
+    old = inherited.get('listen', [])
+    metrics_socks = inherited.get('metrics', [])
+
+    # a slot for every child the pool may grow to
+    slots = sizer.max_children if sizer is not None else childnum
+    if reuseport:
+        LISTENERS = [
+            create_listen_sock(host, port, True, old.pop(0) if old else None,
+                               backlog)
+            for index in range(slots)]
+        if placement is not None:
+            # every child's socket gets its CPU's connections
+            for index, listen_sock in enumerate(LISTENERS):
+                placement.steer(listen_sock, index)
+    else:
+        LISTENERS = [create_listen_sock(
+            host, port, listen_sock=old.pop(0) if old else None,
+            backlog=backlog)] * slots
+    # the rest is of no use with the new command line
+    if not metrics_address:
+        old.extend(metrics_socks)
+    for sock in old:
+        sock.close()
 
     print('Listening on port %d ...' % port)
 
+    # before forking, children share the slab
+    STATS = stats.Slab(slots, histograms=True)
+
     # prefork children
-    global PIDS
-    PIDS = [create_child(index, listen_sock) for index in range(childnum)]
+    PIDS = [None] * slots
+    for index in range(childnum):
+        PIDS[index] = create_child(index, LISTENERS[index])
+
+    if metrics_address:
+        REPORTER = metrics.Reporter(metrics_address, STATS, LISTENERS,
+                                    metrics_socks[0] if metrics_socks else None)
 
     # setup SIGTERM handler - in case the parent is killed
     signal.signal(signal.SIGTERM, _cleanup)
 
-    # parent never calls 'accept' - children do all the work
-    # all parent does is sleeping :)
-    signal.pause()
+    try:
+        parent_forever(sizer)
+    except KeyboardInterrupt:
+        print()
+        listener.print_overflows()
+        _cleanup(None, None)
 
 
 def main():
@@ -143,12 +550,49 @@ def main():
         help='Port. Default is 2000')
 
     parser.add_option(
-        '-n', '--child-num', dest='childnum', type='int', default=10,
-        help='Number of children to prefork. Default is 10')
+        '-n', '--child-num', dest='childnum', type='int',
+        default=len(affinity.available_cpus()),
+        help=('Number of children to prefork. Default is the number of '
+              'available CPUs'))
+
+    parser.add_option(
+        '-r', '--reuseport', dest='reuseport', action='store_true',
+        default=False,
+        help='Give every child its own SO_REUSEPORT listening socket')
+
+    parser.add_option(
+        '-a', '--accept', dest='strategy', default='accept',
+        choices=ACCEPT_STRATEGIES,
+        help=('How children wait for connections: %s. Default is accept'
+              % ', '.join(ACCEPT_STRATEGIES)))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    metrics.add_options(parser)
+    pool.add_options(parser)
+    # a child takes one connection at a time
+    listener.add_options(parser, batch=False)
+    affinity.add_options(parser)
 
     options, args = parser.parse_args()
 
-    serve_forever(options.host, options.port, options.childnum)
+    sizer = pool.create_sizer(options)
+    if sizer is not None and options.reuseport:
+        # a retired child's queue would go with it
+        parser.error('--reuseport needs a fixed number of children')
+    try:
+        placement = affinity.create_placement(options)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # before forking, children share the pool
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    serve_forever(options.host, options.port, options.childnum,
+                  options.reuseport, options.strategy, options.metrics,
+                  sizer, pool.create_recycler(options), options.backlog,
+                  placement)
 
 if __name__ == '__main__':
     main()
@@ -22,55 +22,142 @@
 #
 ###############################################################################
 
+"""
+TCP Preforked Server, connection distribution demo.
+
+Same as server03.py, but every child counts how many times it woke up
+and how many of those wakeups gave it a connection, along with the bytes
+it sent, the connections that failed and the time it spent handling
+them. The counters live in a shared stats slab (see stats.py) and are
+printed when the server is stopped with Ctrl-C.
+
+Compare the accept strategies (--accept):
+
+    accept         - all children block in 'accept' (the default)
+    mutex          - only the child holding an fcntl lock blocks in
+                     'accept', the rest wait for the lock (like Apache)
+    epoll          - every child waits in its own 'epoll' instance,
+                     all of them wake up on a new connection
+    epollexclusive - the same with EPOLLEXCLUSIVE, the kernel wakes
+                     up only one of them
+
+There's a child per available CPU by default; --pin and --cpus place
+them (see affinity.py).
+"""
+
 __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
 
 import os
-import mmap
+import time
+import fcntl
 import errno
+import select
 import signal
 import socket
 import optparse
+import tempfile
 
-BACKLOG = 5
+import stats
+import affinity
+import payload
+import static
+import listener
+import protocol
 
 # stores pids of all preforked children
 PIDS = []
 
-# anonymous memory-mapped file that holds
-# counters for child processes to count how many times
-# they called 'accept' and got new connection socket
-MAP = None
+# shared stats slab, children count how many times they woke up,
+# got new connection socket or got EAGAIN
+STATS = None
 
+ACCEPT_STRATEGIES = ['accept', 'mutex', 'epoll', 'epollexclusive']
+# how children wait for new connections, one of ACCEPT_STRATEGIES
+STRATEGY = 'accept'
 
-def handle(sock):
-    # read a line that tells us how many bytes to write back
-    bytes = int(sock.recv(1024))
-    # get our random bytes
-    data = os.urandom(bytes)
+# file all children lock in the 'mutex' strategy
+LOCK_FILE = None
 
-    print('Got request to send %d bytes. Sending them all...' % bytes)
-    # send them all
-    sock.sendall(data)
+# which CPUs children run on, if not left to the scheduler
+PLACEMENT = None
 
 
-def child_loop(index, listen_sock):
-    """Main child loop."""
+def handle(sock, slot):
+    # read requests until the client closes the connection,
+    # a legacy client sends only one
+    for version, kind, arg in protocol.read_requests(sock):
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            slot.add(stats.BYTES_SENT, static.send_file(sock, version, arg))
+            continue
+
+        bytes = arg
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        # send them all, chunk by chunk
+        slot.add(stats.BYTES_SENT,
+                 payload.send_response(sock, version, bytes))
+
+
+def accept(slot, listen_sock):
+    """Returns a new connection or None if another child got it."""
     while True:
-        # block waiting for connection to handle
         try:
-            conn, client_address = listen_sock.accept()
+            # the listening socket may be non-blocking, the connection isn't
+            conn = listener.accept(listen_sock, blocking=True)
         except IOError as e:
             code, msg = e.args
             if code == errno.EINTR:
                 continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # woke up for nothing
+                slot.add(stats.EAGAINS)
+                return None
             else:
                 raise
+        return conn
+
+
+def child_loop(index, listen_sock):
+    """Main child loop."""
+    slot = STATS.slot(index)
+    if STRATEGY in ('epoll', 'epollexclusive'):
+        # every child needs its own epoll instance
+        epoll = select.epoll()
+        flags = select.EPOLLIN
+        if STRATEGY == 'epollexclusive':
+            flags |= select.EPOLLEXCLUSIVE
+        epoll.register(listen_sock.fileno(), flags)
 
-        # the process woke up and got socket connection - update the counter
-        inc_counter(index)
+    while True:
+        # block waiting for connection to handle
+        if STRATEGY == 'mutex':
+            # only one child at a time waits in 'accept'
+            fcntl.lockf(LOCK_FILE, fcntl.LOCK_EX)
+            try:
+                conn = accept(slot, listen_sock)
+            finally:
+                fcntl.lockf(LOCK_FILE, fcntl.LOCK_UN)
+        elif STRATEGY in ('epoll', 'epollexclusive'):
+            epoll.poll()
+            conn = accept(slot, listen_sock)
+        else:
+            conn = accept(slot, listen_sock)
+
+        # the process woke up - update the counters
+        slot.add(stats.WAKEUPS)
+        if conn is None:
+            continue
+        slot.add(stats.ACCEPTS)
 
         # handle request
-        handle(conn)
+        start = time.monotonic_ns()
+        try:
+            handle(conn, slot)
+        except (OSError, ValueError, protocol.ProtocolError):
+            # the client went away or sent garbage, count it and take
+            # the next one
+            slot.add(stats.ERRORS)
+        slot.add(stats.BUSY_NS, time.monotonic_ns() - start)
 
         # close handled socket connection and off to handle another request
         conn.close()
@@ -82,11 +169,13 @@ def create_child(index, listen_sock):
         return pid
 
     print('Child started with PID: %s' % os.getpid())
+    if PLACEMENT is not None:
+        PLACEMENT.apply(index)
     # child never returns
     try:
         child_loop(index, listen_sock)
     except KeyboardInterrupt:
-        pass
+        os._exit(0)
 
 
 def _exit_handler():
@@ -100,7 +189,7 @@ def _exit_handler():
     # wait for all children to finish
     while True:
         try:
-            pid, status = os.wait()
+            pid, status, rusage = os.wait4(-1, 0)
         except OSError as e:
             if e.errno == errno.ECHILD:
                 break
@@ -109,6 +198,7 @@ def _exit_handler():
 
         if pid == 0:
             break
+        payload.print_rss('child PID %s' % pid, rusage)
 
 
 def _cleanup(signum, frame):
@@ -117,46 +207,48 @@ def _cleanup(signum, frame):
     os._exit(0)
 
 
-def create_array(childnum):
-    """Creates anonymous memory mapped file of the size `childnum`"""
-    map = mmap.mmap(-1, childnum) # anonymous mapped file, numchild bytes
-    map.seek(0)
-    array = bytearray(childnum) # array of zero bytes
-    map.write(array)
-    return map
-
-
-def inc_counter(index):
-    map = MAP
-    map.seek(0)
-    array = bytearray(map.read(1024)) # stats for max 1024 preforked children
-    array[index] += 1
-    map.seek(0)
-    map.write(array)
-
 def print_stats():
-    map = MAP
-    map.seek(0)
-    array = bytearray(map.read(len(PIDS)))
     print()
-    for index, val in enumerate(array):
-        print('child %-2s: %d times' % (index, val))
+    print('accept strategy: %s' % STRATEGY)
+    snapshots = STATS.snapshot_all()
+    for index, child in enumerate(snapshots):
+        print('child %-2s: %d times, woke up %d times, %d for nothing, '
+              'sent %d bytes, %d errors, busy %.1f ms' % (
+                  index, child.accepts, child.wakeups, child.eagains,
+                  child.bytes_sent, child.errors, child.busy_ns / 1e6))
+    totals = STATS.totals(snapshots)
     print()
+    print('useful wakeups: %d, wasted wakeups: %d (%.1f%%)' % (
+        totals.accepts, totals.eagains,
+        100.0 * totals.eagains / (totals.wakeups or 1)))
+    print()
+
 
+def serve_forever(host, port, childnum, strategy='accept',
+                  backlog=listener.BACKLOG, placement=None):
+    global STRATEGY, LOCK_FILE, PLACEMENT
+    STRATEGY = strategy
+    PLACEMENT = placement
+    if strategy == 'mutex':
+        # opened before forking, all children lock the same file
+        LOCK_FILE = tempfile.TemporaryFile()
 
-def serve_forever(host, port, childnum):
     # create, bind, listen
     listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # re-use the port
     listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if strategy in ('epoll', 'epollexclusive'):
+        # children wait in 'epoll', 'accept' must not block
+        # when another child has already taken the connection
+        listen_sock.setblocking(0)
 
     listen_sock.bind((host, port))
-    listen_sock.listen(BACKLOG)
+    listener.listen(listen_sock, backlog)
 
     print('Listening on port %d ...' % port)
 
-    global MAP
-    MAP = create_array(childnum)
+    global STATS
+    STATS = stats.Slab(childnum)
 
     # prefork children
     global PIDS
@@ -172,6 +264,7 @@ def serve_forever(host, port, childnum):
     except KeyboardInterrupt:
         _exit_handler()
         print_stats()
+        listener.print_overflows()
 
 
 def main():
@@ -186,12 +279,35 @@ def main():
         help='Port. Default is 2000')
 
     parser.add_option(
-        '-n', '--child-num', dest='childnum', type='int', default=10,
-        help='Number of children to prefork. Default is 10')
+        '-n', '--child-num', dest='childnum', type='int',
+        default=len(affinity.available_cpus()),
+        help=('Number of children to prefork. Default is the number of '
+              'available CPUs'))
+
+    parser.add_option(
+        '-a', '--accept', dest='strategy', default='accept',
+        choices=ACCEPT_STRATEGIES,
+        help=('How children wait for connections: %s. Default is accept'
+              % ', '.join(ACCEPT_STRATEGIES)))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    # a child takes one connection at a time
+    listener.add_options(parser, batch=False)
+    affinity.add_options(parser)
 
     options, args = parser.parse_args()
+    try:
+        placement = affinity.create_placement(options)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # before forking, children share the pool
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
 
-    serve_forever(options.host, options.port, options.childnum)
+    serve_forever(options.host, options.port, options.childnum,
+                  options.strategy, options.backlog, placement)
 
 if __name__ == '__main__':
     main()
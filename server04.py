@@ -26,6 +26,53 @@
 TCP Preforked Server, Passing Descriptor to Child
 
 Pool of child processes handle client requests.
+
+When a burst of connections arrives the parent accepts until the queue
+is empty and passes several descriptors to a child in a single
+'sendmsg' (SCM_RIGHTS carries an array of descriptors).
+
+Children don't report back after every request. Each child counts the
+connections it has handled in shared memory; the parent compares that
+with the number it has passed to the child to tell whether the child is
+free. Only when there is no free child left does the parent ask to be
+woken up through an eventfd.
+
+A child may have several connections waiting for it (--child-queue) and
+the parent picks the child for every connection with a policy
+(--policy):
+
+    free  - pass connections only to children that are done with all
+            the previous ones, spread evenly (the default)
+    least - the child with the fewest outstanding connections
+    p2c   - the less loaded of two children picked at random
+            ("power of two choices")
+
+Children record how long every connection took from the moment the
+parent passed it on until the response was sent. The latency
+percentiles are printed when the server is stopped with Ctrl-C.
+
+The counters and latency histograms live in a shared stats slab (see
+stats.py); with --metrics the parent also serves them as a plain-text
+report (see metrics.py) from its select loop.
+
+With --min-spare/--max-spare the pool grows and shrinks with the load
+(see pool.py). The parent already knows which children are idle; it
+forks more of them or retires an idle one by closing its pipe.
+
+A child that dies is replaced right away: the parent sees its pipe
+close, forks a new child into its slot and reaps the old one on
+SIGCHLD, without ever stopping to accept. The connections the child
+had not handled are lost and counted as errors. With --max-requests or
+--max-rss-growth the parent also replaces idle children that have
+served enough or grown too much, checking once a second.
+
+SIGHUP or SIGUSR2 restarts the server without refusing a connection:
+a new master takes over the listening socket (see handover.py) and the
+old one closes its children's pipes, waits for them to finish what they
+were passed and exits.
+
+There's a child per available CPU by default; --pin and --cpus place
+them (see affinity.py). The parent stays where the scheduler puts it.
 """
 
 __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
@@ -33,169 +80,650 @@ __author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
 
 import os
 import sys
-import errno
+import mmap
+import time
+import random
 import struct
 import select
+import signal
 import socket
 import optparse
 
-BACKLOG = 5
-
-# keep track of children status (busy or free)
+import pool
+import stats
+import affinity
+import metrics
+import handover
+import payload
+import histogram
+import static
+import listener
+import protocol
+
+# keep track of children status (busy or free), None for an empty slot
 CHILDREN = []
 # child status
 FREE, BUSY = 0, 1
 
+# indexes of free children, used as a stack
+FREE_LIST = []
+
+# pids of retired and dead children not reaped yet
+RETIRED = []
+
+POLICIES = ['free', 'least', 'p2c']
+
+# anonymous memory-mapped file shared with children: the parent's
+# 'waiting for a free child' flag
+MAP = None
+COUNTER_FMT = '<Q'
+COUNTER_SIZE = struct.calcsize(COUNTER_FMT)
+WAITING_OFFSET = 0
+
+# shared stats slab: every child counts its handled connections
+# (stats.HANDLED) and records their latency
+STATS = None
+
+# serves the metrics, if asked to
+REPORTER = None
+
+# tells when to replace a child with a fresh one, if asked to
+RECYCLER = None
+
+# which CPUs children run on, if not left to the scheduler
+PLACEMENT = None
+
+# the parent passes its clock (CLOCK_MONOTONIC is the same
+# in all processes) along with the descriptors
+TIMESTAMP_FMT = '<Q'
+
+# children wake up the parent through this descriptor pair
+# (an eventfd if available, a pipe otherwise)
+WAKEUP_RD, WAKEUP_WR = None, None
+
+# guards against a wakeup lost between setting the flag and sleeping
+WAIT_TIMEOUT = 0.1
+
+# SIGCHLD wakes up the parent through this pipe (the self-pipe trick)
+SIGNAL_RD, SIGNAL_WR = None, None
+
+# the new master while it's starting, the parent goes on dispatching
+SUCCESSOR = None
+
 FMT = '<i'
 
+# max number of descriptors passed to a child at once
+# (the kernel's limit is SCM_MAX_FD, 253)
+BATCH = 16
+
 
-def write_fd(sock, fd):
-    """Write a descriptor to the socket."""
-    data = struct.pack(FMT, fd)
-    return sock.sendmsg([b'1'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, data)])
+def write_fds(sock, fds, msg=b'1'):
+    """Write descriptors to the socket in one message."""
+    data = struct.pack('<%di' % len(fds), *fds)
+    return sock.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, data)])
 
 
-def read_fd(sock):
-    """Read a descriptor from the socket."""
-    data_size, ancdata_size = 1, socket.CMSG_LEN(struct.calcsize(FMT))
+def read_fds(sock, maxfds=BATCH, data_size=1):
+    """Read the message and up to `maxfds` descriptors from the socket."""
+    fd_size = struct.calcsize(FMT)
+    ancdata_size = socket.CMSG_SPACE(maxfds * fd_size)
 
     # read the data and ancillary data from the UNIX domain socket
-    # we're interested only in ancillary data that contains descriptor
+    # we're interested only in ancillary data that contains descriptors
     msg, ancdata, flags, addr = sock.recvmsg(data_size, ancdata_size)
 
-    cmsg_level, cmsg_type, cmsg_data  = ancdata[0]
-    if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
-        fd = struct.unpack(FMT, cmsg_data)[0]
-        return fd
+    fds = []
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            # the data may be padded, ignore the incomplete tail
+            count = len(cmsg_data) // fd_size
+            fds.extend(struct.unpack('<%di' % count,
+                                     cmsg_data[:count * fd_size]))
+    return msg, fds
+
+
+def handle(sock, slot):
+    # read requests until the client closes the connection,
+    # a legacy client sends only one
+    for version, kind, arg in protocol.read_requests(sock):
+        slot.add(stats.REQUESTS)
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            slot.add(stats.BYTES_SENT, static.send_file(sock, version, arg))
+            continue
+
+        bytes_num = arg
+        print('Got request to send %s bytes. Sending them all...' % bytes_num)
+        # send them all, chunk by chunk
+        slot.add(stats.BYTES_SENT,
+                 payload.send_response(sock, version, bytes_num))
+
+
+def child_loop(index, parent_pipe, batch=BATCH):
+    """Main child loop."""
+    slot = STATS.slot(index)
+    while True:
+        # block waiting for descriptors from the parent
+        msg, fds = read_fds(
+            parent_pipe, batch, struct.calcsize(TIMESTAMP_FMT))
+        if not fds: # the parent has gone away
+            os._exit(0)
+        dispatched_at, = struct.unpack(TIMESTAMP_FMT, msg)
+
+        slot.add(stats.ACCEPTS, len(fds))
+        for fd in fds:
+            # create a socket object from the desriptor passed by the parent.
+            # this socket represents connection to a client
+            conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+
+            start = time.monotonic_ns()
+            try:
+                handle(conn, slot)
+            except (OSError, ValueError, protocol.ProtocolError):
+                # the client went away or sent garbage, count it and take
+                # the next one
+                slot.add(stats.ERRORS)
+
+            # close handled socket connection and off to handle another request
+            conn.close()
+            os.close(fd)
 
+            now = time.monotonic_ns()
+            slot.add(stats.BUSY_NS, now - start)
+            slot.record_latency(now - dispatched_at)
 
-def handle(sock):
-    # read a line that tells us how many bytes to write back
-    bytes_num = int(sock.recv(1024))
-    data = b'*' * bytes_num
+        # let the parent know we're free to handle another request;
+        # it only needs a wakeup when it ran out of free children
+        slot.add(stats.HANDLED, len(fds))
+        if get_counter(WAITING_OFFSET):
+            wake_parent()
 
-    print('Got request to send %s bytes. Sending them all...' % bytes_num)
-    # send them all
-    sock.sendall(data)
 
+def create_map():
+    """Creates anonymous memory mapped file with the shared flag"""
+    # anonymous mapped file, it's initially filled with zero bytes
+    return mmap.mmap(-1, COUNTER_SIZE)
 
-def child_loop(index, parent_pipe):
-    """Main child loop."""
-    while True:
-        # block waiting for a descriptor from the parent
-        fd = read_fd(parent_pipe)
 
-        # create a socket object from the desriptor passed by the parent.
-        # this socket represents connection to a client
-        conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+def get_counter(offset):
+    return struct.unpack_from(COUNTER_FMT, MAP, offset)[0]
 
-        handle(conn)
 
-        # close handled socket connection and off to handle another request
-        conn.close()
-        os.close(fd)
+def set_counter(offset, value):
+    struct.pack_into(COUNTER_FMT, MAP, offset, value)
 
-        # signal to the parent that we're free to handle another request
-        parent_pipe.send(b'1')
 
+def handled(index):
+    # only the child itself writes to its counter
+    return STATS.get(index, stats.HANDLED)
 
-def create_child(index, listen_sock):
+
+def print_latency(policy):
+    latencies = STATS.histogram()
+    print()
+    print('policy: %s, connections: %d' % (policy, latencies.count))
+    if not latencies.count:
+        return
+
+    summary = latencies.summary()
+    for percentile in histogram.PERCENTILES:
+        print('p%-5s: %10.3f ms' % (percentile, summary['p%s' % percentile]))
+    print('max   : %10.3f ms' % summary['max'])
+    print()
+
+
+def print_rss():
+    """Reap children (Ctrl-C stops them too) and print their peak RSS."""
+    pids = [CHILDREN[index]['pid'] for index in live_children()] + RETIRED
+    for pid in pids:
+        pid, status, rusage = os.wait4(pid, 0)
+        payload.print_rss('child PID %s' % pid, rusage)
+    payload.print_rss('parent')
+
+
+def create_wakeup():
+    """Returns read and write descriptors of the wakeup channel."""
+    if hasattr(os, 'eventfd'):
+        fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        return fd, fd
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    os.set_blocking(wfd, False)
+    return rfd, wfd
+
+
+def wake_parent():
+    try:
+        # eventfd wants exactly 8 bytes, a pipe doesn't care
+        os.write(WAKEUP_WR, struct.pack(COUNTER_FMT, 1))
+    except BlockingIOError:
+        # the parent has plenty of wakeups pending already
+        pass
+
+
+def clear_wakeup():
+    try:
+        os.read(WAKEUP_RD, 4096)
+    except BlockingIOError:
+        pass
+
+
+def live_children():
+    """Returns the indexes of running children."""
+    return [index for index, child in enumerate(CHILDREN)
+            if child is not None]
+
+
+def reclaim_children():
+    """Move children that handled all their connections to FREE_LIST."""
+    for index in live_children():
+        child = CHILDREN[index]
+        if (child['status'] == BUSY and
+                handled(index) == child['dispatched']):
+            child['status'] = FREE
+            FREE_LIST.append(index)
+
+
+def outstanding(index):
+    """Number of connections passed to the child and not handled yet"""
+    return CHILDREN[index]['dispatched'] - handled(index)
+
+
+def spare_capacity(policy, child_queue):
+    """How many connections children can take right now"""
+    if policy == 'free':
+        if not FREE_LIST:
+            reclaim_children()
+        return len(FREE_LIST) * child_queue
+    return sum(max(child_queue - outstanding(index), 0)
+               for index in live_children())
+
+
+def pick_child(policy, child_queue):
+    """Returns index of the child to pass the next connection to."""
+    indexes = live_children()
+    if policy == 'p2c' and len(indexes) > 1:
+        first, second = random.sample(indexes, 2)
+        if outstanding(second) < outstanding(first):
+            first = second
+        if outstanding(first) < child_queue:
+            return first
+        # both are full - fall back to the full scan
+
+    index = min(indexes, key=outstanding)
+    if outstanding(index) < child_queue:
+        return index
+
+
+def dispatch(index, conns, batch, listen_sock):
+    """Pass connections to the child, at most `batch` in one message."""
+    timestamp = struct.pack(TIMESTAMP_FMT, time.monotonic_ns())
+    while conns:
+        chunk = conns[:batch]
+        try:
+            # pass the connections' descriptors to the child
+            write_fds(CHILDREN[index]['pipe'], [conn.fileno() for conn in chunk],
+                      timestamp)
+        except (BrokenPipeError, ConnectionResetError):
+            # the child died before the parent noticed, its
+            # replacement gets the connections it didn't
+            CHILDREN[index]['dispatched'] -= len(conns)
+            replace_child(index, listen_sock, batch)
+            child = CHILDREN[index]
+            FREE_LIST.remove(index)
+            child['status'] = BUSY
+            child['dispatched'] += len(conns)
+            continue
+        conns = conns[batch:]
+        # server doesn't need these connections any more
+        for conn in chunk:
+            conn.close()
+
+
+def create_child(index, listen_sock, batch=BATCH):
     # create an unnamed pair of TCP connected sockets in UNIX domain.
     # descriptors will be passed through these sockets
     child_pipe, parent_pipe = socket.socketpair()
 
-    pid = os.fork()
+    # until the child has reset the parent's signal handlers a signal
+    # sent to it waits, or it would land in the parent's wakeup pipe
+    mask = signal.pthread_sigmask(
+        signal.SIG_BLOCK, (signal.SIGCHLD,) + handover.SIGNALS)
+    try:
+        pid = os.fork()
+    except OSError:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        raise
     if pid > 0: # parent
-        CHILDREN.append({'status': FREE, 'pipe': child_pipe, 'pid': pid})
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        # the counter of handled connections goes on from the slot's
+        # previous child
+        CHILDREN[index] = {'status': FREE, 'pipe': child_pipe, 'pid': pid,
+                           'dispatched': handled(index)}
+        if RECYCLER is not None:
+            CHILDREN[index]['start'] = RECYCLER.start(
+                STATS.get(index, stats.REQUESTS), pid)
+        FREE_LIST.append(index)
         print('Starting child with PID: %s' % pid)
         # close unused descriptor
         parent_pipe.close()
         return pid
 
     # this is child
+    if PLACEMENT is not None:
+        PLACEMENT.apply(index)
 
-    # close unused copies of descriptors
+    # close unused copies of descriptors, including the pipes of
+    # children forked before, or they'd never see their pipe closed
     child_pipe.close()
     listen_sock.close()
+    for child in CHILDREN:
+        if child is not None:
+            child['pipe'].close()
+    if REPORTER is not None:
+        REPORTER.sock.close()
+    if SUCCESSOR is not None:
+        SUCCESSOR.channel.close()
+    # the parent's signal plumbing
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGCHLD,) + handover.SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    os.close(SIGNAL_RD)
+    os.close(SIGNAL_WR)
+    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
 
     # child never returns
-    child_loop(index, parent_pipe)
-
-
-def serve_forever(host, port, childnum):
-    # create, bind. listen
-    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # re-use the port
-    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        child_loop(index, parent_pipe, batch)
+    except KeyboardInterrupt:
+        os._exit(0)
+
+
+def retire_child(index):
+    """Close the idle child's pipe, it exits when it reads the EOF."""
+    child = CHILDREN[index]
+    print('Retiring child with PID: %s' % child['pid'])
+    if index in FREE_LIST:
+        FREE_LIST.remove(index)
+    child['pipe'].close()
+    CHILDREN[index] = None
+    RETIRED.append(child['pid'])
+
+
+def replace_child(index, listen_sock, batch, reaped=False):
+    """Fork a new child into the slot of the one that died."""
+    child = CHILDREN[index]
+    print('Child %d (PID: %s) terminated, starting a new one' % (
+        index, child['pid']))
+    lost = outstanding(index)
+    if lost:
+        # nobody writes to the slot until the next child starts
+        slot = STATS.slot(index)
+        slot.add(stats.ERRORS, lost)
+        slot.add(stats.HANDLED, lost)
+    if index in FREE_LIST:
+        FREE_LIST.remove(index)
+    child['pipe'].close()
+    CHILDREN[index] = None
+    if not reaped:
+        RETIRED.append(child['pid'])
+    create_child(index, listen_sock, batch)
+
+
+def reap_children(listen_sock, batch):
+    """Reap the children that exited, replace the ones nobody retired."""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+        if pid in RETIRED:
+            RETIRED.remove(pid)
+            continue
+        for index in live_children():
+            if CHILDREN[index]['pid'] == pid:
+                # died before the parent saw its pipe close
+                replace_child(index, listen_sock, batch, reaped=True)
+
+
+def _wake_up(signum, frame):
+    """SIGCHLD and upgrade signal handler, 'signal.set_wakeup_fd' does
+    the work"""
+
+
+def upgrade(listen_sock):
+    """Start a new master with the sockets, 'hand_over' once it's
+    ready."""
+    global SUCCESSOR
+    if SUCCESSOR is not None:
+        # already on the way
+        return
+    socks = [('listen', listen_sock)]
+    if REPORTER is not None:
+        socks.append(('metrics', REPORTER.sock))
+    SUCCESSOR = handover.Successor(socks)
+
+
+def hand_over(listen_sock):
+    """The new master is ready: let the children finish the connections
+    they were passed and exit."""
+    # the new master accepts from now on
+    listen_sock.close()
+    for index in live_children():
+        retire_child(index)
+    handover.drain(RETIRED)
+    print('Old master (PID: %s) is done' % os.getpid())
+    sys.exit(0)
+
+
+def recycle_children(recycler, listen_sock, batch):
+    """Replace idle children that have served enough or grown too much."""
+    recycler.checked()
+    for index in live_children():
+        child = CHILDREN[index]
+        if not outstanding(index) and recycler.expired(
+                child['start'], STATS.get(index, stats.REQUESTS),
+                child['pid']):
+            retire_child(index)
+            # the retired child won't touch the slot any more
+            create_child(index, listen_sock, batch)
+
+
+def maintain_pool(sizer, listen_sock, batch):
+    """Fork or retire children to keep the number of idle ones between
+    the sizer's limits."""
+    live = live_children()
+    idle = [index for index in live if not outstanding(index)]
+
+    count = sizer.adjust(len(live), len(idle))
+    if count < 0:
+        retire_child(idle[-1])
+
+    for _ in range(count):
+        create_child(CHILDREN.index(None), listen_sock, batch)
+
+
+def serve_forever(host, port, childnum, batch=BATCH, policy='free',
+                  child_queue=BATCH, metrics_address=None, sizer=None,
+                  recycler=None, backlog=listener.BACKLOG,
+                  accept_batch=listener.ACCEPT_BATCH, placement=None):
+    # sockets of the old master if it's a restart
+    inherited = handover.inherit()
+    if 'listen' in inherited:
+        listen_sock = inherited['listen'][0]
+    else:
+        # create, bind. listen
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # re-use the port
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_sock.bind((host, port))
+    listener.listen(listen_sock, backlog)
     # put listening socket into non-blocking mode
     listen_sock.setblocking(0)
-
-    listen_sock.bind((host, port))
-    listen_sock.listen(BACKLOG)
+    metrics_socks = inherited.get('metrics', [])
+    if not metrics_address:
+        # of no use with the new command line
+        for sock in metrics_socks:
+            sock.close()
 
     print('Listening on port %d ...' % port)
 
-    # read, write, exception lists with sockets to poll
-    main_rlist, wlist, elist = [listen_sock], [], []
+    # a slot for every child the pool may grow to
+    slots = sizer.max_children if sizer is not None else childnum
+
+    global MAP, STATS, REPORTER, RECYCLER, PLACEMENT, WAKEUP_RD, WAKEUP_WR
+    PLACEMENT = placement
+    MAP = create_map()
+    STATS = stats.Slab(slots, histograms=True)
+    RECYCLER = recycler
+    WAKEUP_RD, WAKEUP_WR = create_wakeup()
+
+    global SIGNAL_RD, SIGNAL_WR
+    SIGNAL_RD, SIGNAL_WR = os.pipe()
+    os.set_blocking(SIGNAL_RD, False)
+    os.set_blocking(SIGNAL_WR, False)
+    signal.set_wakeup_fd(SIGNAL_WR)
+    for signum in (signal.SIGCHLD,) + handover.SIGNALS:
+        signal.signal(signum, _wake_up)
 
     # prefork children
+    CHILDREN[:] = [None] * slots
     for index in range(childnum):
-        create_child(index, listen_sock)
-        # watch the socket
-        main_rlist.append(CHILDREN[index]['pipe'])
-
-    FREE_CHILD_COUNT = childnum
+        create_child(index, listen_sock, batch)
+
+    if metrics_address:
+        # children don't accept, they never wake up for nothing
+        counters = [name for name in stats.COUNTERS
+                    if name not in ('wakeups', 'eagains')]
+        REPORTER = metrics.Reporter(metrics_address, STATS, [listen_sock],
+                                    metrics_socks[0] if metrics_socks else None,
+                                    counters)
+    # if it's a restart, the old master can go
+    handover.ready()
+
+    # a free child can't take more than one batch at once
+    if policy == 'free':
+        child_queue = min(child_queue, batch)
+
+    try:
+        dispatch_forever(listen_sock, batch, policy, child_queue, sizer,
+                         recycler, accept_batch)
+    except KeyboardInterrupt:
+        print_latency(policy)
+        listener.print_overflows()
+        print_rss()
+
+
+def dispatch_forever(listen_sock, batch, policy, child_queue, sizer=None,
+                     recycler=None, accept_batch=listener.ACCEPT_BATCH):
+    global SUCCESSOR
+    wlist, elist = [], []
 
     while True:
-        # read list with sockets to poll
-        rlist = main_rlist.copy()
-
-        # if we don't have a free child, stop accepting connections
+        # children never write to their pipes, they become readable
+        # only when a child terminates
+        pipes = [CHILDREN[index]['pipe'] for index in live_children()]
+
+        timeout = None
+        spare = spare_capacity(policy, child_queue)
+        if not spare:
+            # ask children to wake us up and check once more,
+            # one of them might have finished before seeing the flag
+            set_counter(WAITING_OFFSET, 1)
+            spare = spare_capacity(policy, child_queue)
+            timeout = WAIT_TIMEOUT
+        if spare:
+            set_counter(WAITING_OFFSET, 0)
+            timeout = None
+        for periodic in (sizer, recycler):
+            if periodic is not None:
+                timeout = min(periodic.timeout(), timeout or periodic.interval)
+
+        # if children can't take more connections, stop accepting them
         # (although the kernel will still be queueing up new connections
-        # because of the BACKLOG)
-        if FREE_CHILD_COUNT == 0:
-            rlist.remove(listen_sock)
+        # because of the backlog) and wait for a child to finish
+        rlist = [listen_sock if spare else WAKEUP_RD, SIGNAL_RD] + pipes
+        if REPORTER is not None:
+            rlist.append(REPORTER)
+        if SUCCESSOR is not None:
+            # go on dispatching while the new master starts
+            rlist.append(SUCCESSOR)
+            if timeout is None:
+                timeout = SUCCESSOR.timeout()
+            else:
+                timeout = min(timeout, SUCCESSOR.timeout())
 
         # block in select
-        readables, writables, exceptions = select.select(rlist, wlist, elist)
+        readables, writables, exceptions = select.select(
+            rlist, wlist, elist, timeout)
 
-        if listen_sock in readables: # new client connection, we can accept now
+        if WAKEUP_RD in readables:
+            clear_wakeup()
+
+        if SIGNAL_RD in readables:
             try:
-                conn, client_address = listen_sock.accept()
-            except IOError as e:
-                code, msg = e.args
-                if code == errno.EINTR:
-                    continue
-                else:
-                    raise
-
-            # find a free child to pass the connection to
-            for child in CHILDREN:
-                if child['status'] == FREE: # free
-                    # mark as busy
-                    child['status'] = BUSY
+                # the numbers of the signals that arrived
+                signums = os.read(SIGNAL_RD, 4096)
+            except BlockingIOError:
+                signums = b''
+            reap_children(listen_sock, batch)
+            if any(signum in handover.SIGNALS for signum in signums):
+                upgrade(listen_sock)
+
+        if REPORTER in readables:
+            # the parent knows about connections children haven't got yet
+            REPORTER.serve([outstanding(index) for index in live_children()])
 
-                    # pass the connection's descriptor to the child
-                    write_fd(child['pipe'], conn.fileno())
-                    # server doesn't need this connection any more
-                    conn.close()
+        if listen_sock in readables: # new client connection, we can accept now
+            # drain the queue, but don't take more than children
+            # can get in one go; children do blocking I/O
+            conns = listener.accept_batch(
+                listen_sock, min(spare, accept_batch), blocking=True)
+
+            if policy == 'free':
+                # spread the connections evenly over free children
+                per_child = -(-len(conns) // len(FREE_LIST))
+                while conns:
+                    index = FREE_LIST.pop()
+                    child = CHILDREN[index]
+                    chunk, conns = conns[:per_child], conns[per_child:]
 
-                    FREE_CHILD_COUNT -= 1
-                    break
+                    # mark as busy
+                    child['status'] = BUSY
+                    child['dispatched'] += len(chunk)
+                    dispatch(index, chunk, batch, listen_sock)
             else:
-                # this shouldn't happen
-                raise Exception('No free child found')
-
-        # find newly-available children
-        for child in CHILDREN:
-            child_pipe = child['pipe']
-            if child_pipe in readables:
-                data = child_pipe.recv(1)
-                if not data:
-                    # child terminated
-                    raise Exception('Child terminated unexpectedly')
-                child['status'] = FREE # free
-                FREE_CHILD_COUNT += 1
+                # pick a child for every connection, then pass each
+                # child all of its connections at once
+                chunks = {}
+                for conn in conns:
+                    index = pick_child(policy, child_queue)
+                    chunks.setdefault(index, []).append(conn)
+                    CHILDREN[index]['dispatched'] += 1
+                for index, chunk in chunks.items():
+                    dispatch(index, chunk, batch, listen_sock)
+
+        for index in live_children():
+            if CHILDREN[index]['pipe'] in readables:
+                # child terminated
+                replace_child(index, listen_sock, batch)
+
+        if sizer is not None and sizer.due():
+            maintain_pool(sizer, listen_sock, batch)
+
+        if recycler is not None and recycler.due():
+            recycle_children(recycler, listen_sock, batch)
+
+        if SUCCESSOR is not None and (SUCCESSOR in readables or
+                                      not SUCCESSOR.timeout()):
+            ready = SUCCESSOR.check()
+            if ready is not None:
+                SUCCESSOR = None
+            if ready:
+                hand_over(listen_sock)
 
 
 def main():
@@ -210,12 +738,47 @@ def main():
         help='Port. Default is 2000')
 
     parser.add_option(
-        '-n', '--child-num', dest='childnum', type='int', default=10,
-        help='Number of children to prefork. Default is 10')
+        '-n', '--child-num', dest='childnum', type='int',
+        default=len(affinity.available_cpus()),
+        help=('Number of children to prefork. Default is the number of '
+              'available CPUs'))
 
-    options, args = parser.parse_args()
+    parser.add_option(
+        '-b', '--batch', dest='batch', type='int', default=BATCH,
+        help=('Max number of descriptors passed to a child at once. '
+              'Default is %d' % BATCH))
 
-    serve_forever(options.host, options.port, options.childnum)
+    parser.add_option(
+        '-P', '--policy', dest='policy', default='free', choices=POLICIES,
+        help=('How to pick a child for a connection: %s. Default is free'
+              % ', '.join(POLICIES)))
+
+    parser.add_option(
+        '-q', '--child-queue', dest='child_queue', type='int', default=BATCH,
+        help=('Max number of connections passed to a child and not handled '
+              'yet. Default is %d' % BATCH))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    metrics.add_options(parser)
+    pool.add_options(parser)
+    listener.add_options(parser)
+    affinity.add_options(parser)
+
+    options, args = parser.parse_args()
+    try:
+        placement = affinity.create_placement(options)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # before forking, children share the pool
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    serve_forever(options.host, options.port, options.childnum, options.batch,
+                  options.policy, options.child_queue, options.metrics,
+                  pool.create_sizer(options), pool.create_recycler(options),
+                  options.backlog, options.accept_batch, placement)
 
 
 if __name__ == '__main__':
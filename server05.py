@@ -0,0 +1,349 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+TCP Concurrent Server, I/O Multiplexing (epoll).
+
+Single server process to handle any number of clients.
+
+Unlike server02.py, descriptors are registered with the kernel once
+in edge-triggered mode and 'epoll' returns only the ready ones, so the
+cost of one loop iteration doesn't depend on the number of connections.
+
+Like server02.py it stops reading from a client that doesn't read its
+responses once --high-water bytes are queued for it, and answers the
+requests a client sent before it half-closed the connection.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import errno
+import select
+import socket
+import optparse
+import itertools
+import collections
+
+import static
+import payload
+import listener
+import protocol
+
+# max number of events returned by a single 'epoll_wait' call
+MAX_EVENTS = 1024
+
+# stop reading from a client once that many bytes are queued for it
+HIGH_WATER = 64 * 1024
+
+# maps a descriptor to the connection state:
+#   'sock'   - connected socket
+#   'parser' - request parser holding the data read so far
+#   'outbuf' - queue of memoryviews, payload streams (payload.Stream)
+#              and files (static.OpenFile) of the responses not yet sent
+#   'eof'    - the client has sent everything, close once 'outbuf' is sent
+#   'paused' - stopped reading at the high-water mark, the rest of the
+#              requests waits in the socket
+CONNECTIONS = {}
+
+
+def accept_all(lstsock, epoll, accept_batch=listener.ACCEPT_BATCH):
+    """Returns True if there may be more connections to accept."""
+    # in edge-triggered mode we're notified only once,
+    # so accept until the queue of pending connections is empty -
+    # or the batch is full, then the rest waits for the next iteration
+    conns = listener.accept_batch(lstsock, accept_batch)
+    for conn in conns:
+        fd = conn.fileno()
+        CONNECTIONS[fd] = {
+            'sock': conn,
+            'parser': protocol.RequestParser(),
+            'outbuf': collections.deque(),
+            'eof': False,
+            'paused': False,
+            }
+        # register once for both directions, no need to modify later
+        epoll.register(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLET)
+    return len(conns) == accept_batch
+
+
+def _is_file(item):
+    return isinstance(item, static.OpenFile)
+
+
+def _gather(outbuf):
+    """Returns buffers to send with one 'sendmsg' and its flags."""
+    views = []
+    for item in itertools.islice(outbuf, protocol.IOV_MAX):
+        if _is_file(item):
+            # a file follows - don't push the header out on its own
+            return views, socket.MSG_MORE
+        if isinstance(item, payload.Stream):
+            chunk = item.next_chunk()
+            views.append(chunk)
+            if len(chunk) < len(item):
+                # the next chunk is made once this one is sent
+                break
+        else:
+            views.append(item)
+    return views, 0
+
+
+def queued_bytes(outbuf):
+    return sum(len(item) for item in outbuf)
+
+
+def close(fd, epoll):
+    conn = CONNECTIONS.pop(fd)
+    epoll.unregister(fd)
+    conn['sock'].close()
+    for item in conn['outbuf']:
+        if _is_file(item):
+            item.close()
+
+
+def queue_responses(sock, parser, outbuf):
+    """Queue the responses to the complete requests in the parser."""
+    # a framed client may have sent several requests at once
+    for version, kind, arg in parser:
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            response = static.open_file(arg)
+            if isinstance(response, str): # error message
+                outbuf.append(memoryview(protocol.pack_error(response)))
+            else:
+                static.set_nodelay(sock)
+                header = protocol.pack_response_header(len(response))
+                outbuf.append(memoryview(header))
+                if len(response):
+                    outbuf.append(response)
+                else:
+                    response.close()
+            continue
+
+        bytes = arg
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        if version != protocol.LEGACY:
+            header = protocol.pack_response_header(bytes)
+            outbuf.append(memoryview(header))
+        if bytes:
+            # produced chunk by chunk as the socket takes it
+            outbuf.append(payload.Stream(bytes))
+
+
+def handle_read(fd, epoll, high_water=HIGH_WATER):
+    conn = CONNECTIONS[fd]
+    sock, parser, outbuf = conn['sock'], conn['parser'], conn['outbuf']
+    conn['paused'] = False
+
+    # read until EAGAIN, otherwise we won't be notified again
+    while not conn['eof']:
+        if queued_bytes(outbuf) >= high_water:
+            # the socket is most likely writable right now
+            handle_write(fd, epoll)
+            if fd not in CONNECTIONS:
+                return
+            if queued_bytes(outbuf) >= high_water:
+                # the client is not keeping up with us - stop reading its
+                # requests until EPOLLOUT says it has taken some responses
+                conn['paused'] = True
+                return
+
+        try:
+            nbytes = parser.recv_into(sock)
+        except IOError as e:
+            code, msg = e.args
+            if code == errno.EINTR:
+                continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            elif code == errno.ECONNRESET:
+                close(fd, epoll)
+                return
+            else:
+                raise
+
+        if not nbytes:
+            # the client has closed (or half-closed) the connection,
+            # answer the requests it has sent so far
+            conn['eof'] = True
+
+        try:
+            queue_responses(sock, parser, outbuf)
+        except (ValueError, protocol.ProtocolError):
+            close(fd, epoll)
+            return
+
+    # don't wait for the next EPOLLOUT edge - the socket is most likely
+    # writable right now
+    handle_write(fd, epoll)
+
+
+def handle_write(fd, epoll):
+    conn = CONNECTIONS[fd]
+    sock, outbuf = conn['sock'], conn['outbuf']
+
+    # write until EAGAIN or until there is nothing left to send
+    while outbuf:
+        head = outbuf[0]
+        try:
+            if _is_file(head):
+                # the kernel copies the file straight to the socket
+                sent = head.send(sock)
+            else:
+                # gather several buffers (e.g. response header and payload)
+                # into one system call, up to the next file
+                views, flags = _gather(outbuf)
+                sent = sock.sendmsg(views, [], flags)
+        except IOError as e:
+            code, msg = e.args
+            if code == errno.EINTR:
+                continue
+            elif code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            elif code in (errno.EPIPE, errno.ECONNRESET):
+                close(fd, epoll)
+                return
+            else:
+                raise
+
+        if _is_file(head):
+            if not sent: # the file got shorter
+                close(fd, epoll)
+                return
+            if not len(head):
+                outbuf.popleft().close()
+            # otherwise keep going until EAGAIN
+            continue
+
+        while sent:
+            head = outbuf[0]
+            if isinstance(head, payload.Stream):
+                count = min(sent, len(head.chunk))
+                head.consume(count)
+                sent -= count
+                if not len(head):
+                    outbuf.popleft()
+            elif sent >= len(head):
+                sent -= len(outbuf.popleft())
+            else:
+                # partial write - keep the rest without copying
+                outbuf[0] = head[sent:]
+                sent = 0
+
+    if conn['eof'] and not outbuf:
+        # everything the client asked for is sent
+        close(fd, epoll)
+
+
+def serve_forever(host, port, high_water=HIGH_WATER,
+                  backlog=listener.BACKLOG,
+                  accept_batch=listener.ACCEPT_BATCH):
+    # create, bind. listen
+    lstsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # re-use the port
+    lstsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # put listening socket into non-blocking mode
+    lstsock.setblocking(0)
+
+    lstsock.bind((host, port))
+    listener.listen(lstsock, backlog)
+
+    print('Listening on port %d ...' % port)
+
+    epoll = select.epoll()
+    epoll.register(lstsock.fileno(), select.EPOLLIN | select.EPOLLET)
+    lstfd = lstsock.fileno()
+    # connections left in the queue after a full batch
+    pending = False
+
+    while True:
+        # block in epoll, only ready descriptors are returned;
+        # just check them if there's more to accept
+        try:
+            events = epoll.poll(0 if pending else -1, MAX_EVENTS)
+        except IOError as e:
+            code, msg = e.args
+            if code == errno.EINTR:
+                continue
+            else:
+                raise
+
+        for fd, event in events:
+            if fd == lstfd: # new client connection(s), we can accept now
+                pending = True
+                continue
+
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                handle_read(fd, epoll, high_water)
+
+            # the connection might have been closed while reading
+            if fd in CONNECTIONS and event & select.EPOLLOUT:
+                handle_write(fd, epoll)
+                # the client has taken some responses, read the requests
+                # left in the socket
+                if fd in CONNECTIONS and CONNECTIONS[fd]['paused']:
+                    handle_read(fd, epoll, high_water)
+
+        # after the connections we already have got their turn
+        if pending:
+            pending = accept_all(lstsock, epoll, accept_batch)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-i', '--host', dest='host', default='0.0.0.0',
+        help='Hostname or IP address. Default is 0.0.0.0'
+        )
+
+    parser.add_option(
+        '-p', '--port', dest='port', type='int', default=2000,
+        help='Port. Default is 2000')
+
+    parser.add_option(
+        '-w', '--high-water', dest='high_water', type='int',
+        default=HIGH_WATER,
+        help=('Stop reading from a client when that many bytes are queued '
+              'for it. Default is %d' % HIGH_WATER))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    listener.add_options(parser)
+
+    options, args = parser.parse_args()
+
+    # filled once at startup
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    try:
+        serve_forever(options.host, options.port, options.high_water,
+                      options.backlog, options.accept_batch)
+    except KeyboardInterrupt:
+        print()
+        listener.print_overflows()
+        payload.print_rss('server')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+TCP Prethreaded Server
+
+Pool of threads handle client requests.
+
+Two ways to hand connections to the threads:
+
+    lock  - every thread calls 'accept' itself, a mutex makes sure
+            only one of them blocks in 'accept' at a time
+    queue - the main thread accepts and puts connections into a
+            bounded queue, the pool threads take them from there
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+
+import queue
+import errno
+import signal
+import socket
+import optparse
+import threading
+
+import payload
+import static
+import listener
+import protocol
+
+# stores all prethreaded threads
+THREADS = []
+
+
+def handle(sock):
+    # read requests until the client closes the connection,
+    # a legacy client sends only one
+    for version, kind, arg in protocol.read_requests(sock):
+        if kind == protocol.FILE:
+            print('Got request to send file %s. Sending it...' % arg)
+            static.send_file(sock, version, arg)
+            continue
+
+        bytes = arg
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        # send them all, chunk by chunk
+        payload.send_response(sock, version, bytes)
+
+
+def serve_conn(conn):
+    """Handle the connection, a client error must not kill the thread."""
+    try:
+        handle(conn)
+    except (OSError, ValueError, protocol.ProtocolError):
+        # the client went away or sent garbage, take the next one
+        pass
+    finally:
+        # close handled socket connection and off to handle another request
+        conn.close()
+
+
+def thread_lock_loop(index, listen_sock, lock):
+    """Thread loop: accept under the mutex."""
+    while True:
+        # only one thread at a time blocks in 'accept'
+        with lock:
+            try:
+                conn = listener.accept(listen_sock, blocking=True)
+            except IOError as e:
+                code, msg = e.args
+                if code == errno.EINTR:
+                    continue
+                else:
+                    raise
+
+        serve_conn(conn)
+
+
+def thread_queue_loop(index, conn_queue):
+    """Thread loop: take connections accepted by the main thread."""
+    while True:
+        conn = conn_queue.get()
+        serve_conn(conn)
+
+
+def create_thread(index, target, *args):
+    thread = threading.Thread(target=target, args=(index,) + args)
+    # don't keep the process alive once the main thread is gone
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def accept_loop(listen_sock, conn_queue):
+    """Main thread loop in the 'queue' mode."""
+    while True:
+        try:
+            conn = listener.accept(listen_sock, blocking=True)
+        except IOError as e:
+            code, msg = e.args
+            if code == errno.EINTR:
+                continue
+            else:
+                raise
+
+        # blocks when the queue is full, new connections then wait
+        # in the kernel's queue (see --backlog)
+        conn_queue.put(conn)
+
+
+def serve_forever(host, port, threadnum, mode='lock', queue_size=None,
+                  backlog=listener.BACKLOG):
+    # create, bind, listen
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # re-use the port
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    listen_sock.bind((host, port))
+    listener.listen(listen_sock, backlog)
+
+    print('Listening on port %d ...' % port)
+
+    global THREADS
+    if mode == 'lock':
+        lock = threading.Lock()
+        THREADS = [create_thread(index, thread_lock_loop, listen_sock, lock)
+                   for index in range(threadnum)]
+        # threads do all the work, the main thread just sleeps
+        # (it must stay alive to get signals like SIGINT)
+        signal.pause()
+    else:
+        # the queue is bounded by the pool size unless told otherwise
+        conn_queue = queue.Queue(maxsize=queue_size or threadnum)
+        THREADS = [create_thread(index, thread_queue_loop, conn_queue)
+                   for index in range(threadnum)]
+        accept_loop(listen_sock, conn_queue)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-i', '--host', dest='host', default='0.0.0.0',
+        help='Hostname or IP address. Default is 0.0.0.0'
+        )
+
+    parser.add_option(
+        '-p', '--port', dest='port', type='int', default=2000,
+        help='Port. Default is 2000')
+
+    parser.add_option(
+        '-n', '--thread-num', dest='threadnum', type='int', default=10,
+        help='Number of threads to prethread. Default is 10')
+
+    parser.add_option(
+        '-m', '--mode', dest='mode', default='lock',
+        choices=['lock', 'queue'],
+        help=('How connections get to the threads: lock or queue. '
+              'Default is lock'))
+
+    parser.add_option(
+        '-q', '--queue-size', dest='queue_size', type='int', default=0,
+        help=('Max number of accepted connections waiting for a thread '
+              'in the queue mode. Default is the number of threads'))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    # threads take one connection at a time
+    listener.add_options(parser, batch=False)
+
+    options, args = parser.parse_args()
+
+    # filled once at startup
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    try:
+        serve_forever(options.host, options.port, options.threadnum,
+                      options.mode, options.queue_size, options.backlog)
+    except KeyboardInterrupt:
+        print()
+        listener.print_overflows()
+        # threads share the process memory
+        payload.print_rss('server')
+
+if __name__ == '__main__':
+    main()
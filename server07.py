@@ -0,0 +1,341 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+TCP Concurrent Server, asyncio.
+
+Single event loop per process built on asyncio.Protocol and transports.
+Optionally several processes share the same listening socket.
+
+With --sendfile the payload comes from a file filled with random bytes
+at startup and goes out with 'loop.sendfile', which uses sendfile(2)
+and never copies the data into user space.
+
+Files requested with FILE requests (--docroot) go out the same way.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import errno
+import signal
+import socket
+import asyncio
+import optparse
+import tempfile
+import collections
+
+import static
+import payload
+import listener
+import protocol
+
+# stores pids of all worker processes
+PIDS = []
+
+
+class RequestProtocol(asyncio.Protocol):
+
+    # file with random bytes to send with 'loop.sendfile' or None
+    payload_file = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # a response goes out in several writes (header, payload or
+        # 'loop.sendfile'), don't let Nagle's algorithm wait for the
+        # client's delayed ACK before sending the rest
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = protocol.RequestParser()
+        # requests waiting for 'loop.sendfile' or too big to write at
+        # once, served one at a time in the order they came in
+        self.pending = collections.deque()
+        self.sending = False
+        # the task serving them, the loop keeps only a weak reference
+        self.sender = None
+        # cleared while the transport's buffer is above its high-water mark
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        # wake up a response waiting for the buffer to drain
+        self.writable.set()
+
+    def data_received(self, data):
+        # a framed client may send several requests at once
+        self.parser.feed(data)
+        try:
+            requests = list(self.parser)
+        except (ValueError, protocol.ProtocolError):
+            self.transport.abort()
+            return
+
+        for version, kind, arg in requests:
+            # big responses are streamed as the client takes them
+            if (kind == protocol.FILE or self.payload_file is not None
+                    or arg > payload.CHUNK_SIZE or self.pending):
+                self.pending.append((version, kind, arg))
+                continue
+
+            self.write_payload(version, arg)
+
+        if self.pending and not self.sending:
+            self.sending = True
+            self.sender = asyncio.ensure_future(self.sendfile())
+
+    def write_payload(self, version, bytes):
+        print('Got request to send %d bytes. Sending them all...' % bytes)
+        # slices of the shared pool (or fresh random bytes),
+        # the transport buffers what can't be written right away
+        if version != protocol.LEGACY:
+            self.transport.write(protocol.pack_response_header(bytes))
+        stream = payload.Stream(bytes)
+        while stream:
+            chunk = stream.next_chunk()
+            self.transport.write(chunk)
+            stream.consume(len(chunk))
+        if version == protocol.LEGACY:
+            # close once the buffer is flushed
+            self.transport.close()
+
+    async def stream_payload(self, version, bytes):
+        print('Got request to send %d bytes. Streaming them...' % bytes)
+        if version != protocol.LEGACY:
+            self.transport.write(protocol.pack_response_header(bytes))
+        stream = payload.Stream(bytes)
+        while stream:
+            # don't let the transport buffer the whole response
+            await self.writable.wait()
+            if self.transport.is_closing():
+                raise ConnectionError('Connection closed')
+            chunk = stream.next_chunk()
+            self.transport.write(chunk)
+            stream.consume(len(chunk))
+
+    async def send_file(self, path):
+        print('Got request to send file %s. Sending it...' % path)
+        response = static.open_file(path)
+        if isinstance(response, str): # error message
+            self.transport.write(protocol.pack_error(response))
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            self.transport.write(protocol.pack_response_header(len(response)))
+            # the cached descriptor stays open after the file object is gone
+            with open(response.fd, 'rb', buffering=0, closefd=False) as f:
+                await loop.sendfile(self.transport, f, 0, len(response))
+        except (OSError, RuntimeError):
+            # the client went away, 'loop.sendfile' raises RuntimeError
+            # once the transport is closing
+            self.transport.abort()
+        finally:
+            response.close()
+
+    def pause_writing(self):
+        # the client is not keeping up with us - stop reading its
+        # requests until the transport's buffer drains
+        self.writable.clear()
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writable.set()
+        self.transport.resume_reading()
+
+    async def sendfile(self):
+        loop = asyncio.get_running_loop()
+        version = None
+        try:
+            while (self.pending and version != protocol.LEGACY and
+                   not self.transport.is_closing()):
+                version, kind, arg = self.pending.popleft()
+                if kind == protocol.FILE:
+                    await self.send_file(arg)
+                    continue
+
+                if self.payload_file is None:
+                    await self.stream_payload(version, arg)
+                    continue
+
+                bytes = arg
+                print('Got request to send %d bytes. Sending them all...' %
+                      bytes)
+                if version != protocol.LEGACY:
+                    self.transport.write(protocol.pack_response_header(bytes))
+                # the file may be smaller than the request - send it in rounds
+                size = os.fstat(self.payload_file.fileno()).st_size
+                while bytes > 0:
+                    count = min(bytes, size)
+                    await loop.sendfile(
+                        self.transport, self.payload_file, 0, count)
+                    bytes -= count
+        except (OSError, RuntimeError):
+            # the client went away (RuntimeError from 'loop.sendfile')
+            self.transport.abort()
+        finally:
+            self.sending = False
+
+        if version == protocol.LEGACY:
+            self.transport.close()
+
+
+def create_payload_file(size):
+    """Creates an unlinked temporary file with `size` random bytes."""
+    payload_file = tempfile.TemporaryFile()
+    while size > 0:
+        chunk = os.urandom(min(size, 65536))
+        payload_file.write(chunk)
+        size -= len(chunk)
+    payload_file.flush()
+    return payload_file
+
+
+async def serve(listen_sock, backlog):
+    loop = asyncio.get_running_loop()
+    # asyncio calls 'listen' again with the backlog and accepts up to
+    # that many connections per wakeup
+    server = await loop.create_server(RequestProtocol, sock=listen_sock,
+                                      backlog=backlog)
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(listen_sock, backlog):
+    try:
+        asyncio.run(serve(listen_sock, backlog))
+    except KeyboardInterrupt:
+        pass
+
+
+def create_child(index, listen_sock, backlog):
+    pid = os.fork()
+    if pid > 0: # parent
+        return pid
+
+    print('Worker started with PID: %s' % os.getpid())
+    # child never returns
+    run_worker(listen_sock, backlog)
+    os._exit(0)
+
+
+def _cleanup(signum, frame):
+    """SIGTERM signal handler"""
+    # terminate all children
+    for pid in PIDS:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except:
+            pass
+
+    # wait for all children to finish
+    while True:
+        try:
+            pid, status, rusage = os.wait4(-1, 0)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                break
+            else:
+                raise
+
+        if pid == 0:
+            break
+        payload.print_rss('worker PID %s' % pid, rusage)
+
+    os._exit(0)
+
+
+def serve_forever(host, port, workernum=1, sendfile_size=0,
+                  backlog=listener.BACKLOG):
+    # create, bind, listen
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # re-use the port
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    listen_sock.bind((host, port))
+    listener.listen(listen_sock, backlog)
+
+    print('Listening on port %d ...' % port)
+
+    if sendfile_size:
+        # created before forking, so all workers share the same file
+        RequestProtocol.payload_file = create_payload_file(sendfile_size)
+
+    if workernum == 1:
+        run_worker(listen_sock, backlog)
+        listener.print_overflows()
+        payload.print_rss('worker')
+        return
+
+    # prefork workers, each one runs its own event loop
+    # on the shared listening socket
+    global PIDS
+    PIDS = [create_child(index, listen_sock, backlog)
+            for index in range(workernum)]
+
+    # setup SIGTERM handler - in case the parent is killed
+    signal.signal(signal.SIGTERM, _cleanup)
+
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        listener.print_overflows()
+        _cleanup(None, None)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-i', '--host', dest='host', default='0.0.0.0',
+        help='Hostname or IP address. Default is 0.0.0.0'
+        )
+
+    parser.add_option(
+        '-p', '--port', dest='port', type='int', default=2000,
+        help='Port. Default is 2000')
+
+    parser.add_option(
+        '-w', '--workers', dest='workernum', type='int', default=1,
+        help='Number of processes sharing the listening socket. Default is 1')
+
+    parser.add_option(
+        '-s', '--sendfile', dest='sendfile_size', type='int', default=0,
+        help=('Send the payload with loop.sendfile from a file of that many '
+              'random bytes. Default is 0 (transport.write)'))
+
+    payload.add_options(parser)
+    static.add_options(parser)
+    # asyncio accepts up to the backlog per wakeup, no separate batch
+    listener.add_options(parser, batch=False)
+
+    options, args = parser.parse_args()
+
+    # before forking, children share the pool
+    payload.init(options.pool_size, options.random)
+    static.init(options.docroot, options.file_cache)
+
+    serve_forever(options.host, options.port,
+                  options.workernum, options.sendfile_size, options.backlog)
+
+if __name__ == '__main__':
+    main()
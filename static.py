@@ -0,0 +1,201 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Static file serving shared by the servers.
+
+A FILE request names a file under the document root (--docroot). The
+server keeps the most recently used files open together with their
+sizes, so a hot file costs neither 'open' nor 'stat', and sends the
+file with sendfile(2): the data goes from the page cache to the socket
+without ever being copied into user space.
+
+Files are served as they were when they were opened: a file replaced
+on disk is picked up once it drops out of the cache.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import os
+import stat
+import socket
+import threading
+import collections
+
+import protocol
+
+CACHE_SIZE = 128
+
+# FileCache for the document root or None if files are not served
+CACHE = None
+
+
+class FileCache(object):
+    """LRU cache of open file descriptors and file sizes.
+
+    A file is opened on the first request and stays open until it is
+    evicted by more recently used files. A file that is still being
+    sent when evicted is closed once the last sender releases it.
+    """
+
+    def __init__(self, docroot, size=CACHE_SIZE):
+        self.docroot = os.path.realpath(docroot)
+        self.size = size
+        # path -> [fd, file size, number of senders, evicted]
+        self.entries = collections.OrderedDict()
+        # fd -> entry of evicted files still being sent
+        self.evicted = {}
+        # threads of the prethreaded server share the cache
+        self.lock = threading.Lock()
+
+    def _open(self, path):
+        fullpath = os.path.realpath(
+            os.path.join(self.docroot, path.lstrip('/')))
+        # don't let '..' or symlinks escape the document root
+        if os.path.commonpath([self.docroot, fullpath]) != self.docroot:
+            raise FileNotFoundError(path)
+        fd = os.open(fullpath, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise IsADirectoryError(path)
+        except OSError:
+            os.close(fd)
+            raise
+        return [fd, st.st_size, 0, False]
+
+    def acquire(self, path):
+        """Returns (fd, size) of the file, call release() when done."""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                entry = self.entries[path] = self._open(path)
+                while len(self.entries) > self.size:
+                    self._evict(self.entries.popitem(last=False)[1])
+            else:
+                # the most recently used files are at the end
+                self.entries.move_to_end(path)
+            entry[2] += 1
+            return entry[0], entry[1]
+
+    def release(self, path, fd):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != fd:
+                # evicted meanwhile - find it among the senders
+                entry = self.evicted.get(fd)
+            entry[2] -= 1
+            if entry[3] and not entry[2]:
+                del self.evicted[fd]
+                os.close(fd)
+
+    def _evict(self, entry):
+        if entry[2]:
+            # still being sent, close it in release()
+            entry[3] = True
+            self.evicted[entry[0]] = entry
+        else:
+            os.close(entry[0])
+
+
+class OpenFile(object):
+    """A file response that can be sent in several steps.
+
+    len() is the number of bytes left to send.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd, self.size = CACHE.acquire(path)
+        self.offset = 0
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def send(self, sock):
+        """Send as much as the socket takes, returns number of bytes."""
+        sent = os.sendfile(sock.fileno(), self.fd, self.offset, len(self))
+        self.offset += sent
+        return sent
+
+    def close(self):
+        if self.fd is not None:
+            CACHE.release(self.path, self.fd)
+            self.fd = None
+
+
+def init(docroot=None, size=CACHE_SIZE):
+    global CACHE
+    CACHE = FileCache(docroot, size) if docroot else None
+
+
+def open_file(path):
+    """Returns OpenFile for the path or an error message."""
+    if CACHE is None:
+        return 'Files are not served'
+    try:
+        return OpenFile(path)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return 'No such file: %s' % path
+    except PermissionError:
+        return 'Permission denied: %s' % path
+
+
+def set_nodelay(sock):
+    """The header goes out with MSG_MORE and the file tail right after
+    it, don't let Nagle's algorithm hold the tail back waiting for the
+    client's delayed ACK."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_file(sock, version, path):
+    """Send the whole file to the blocking socket, returns the number of
+    file bytes."""
+    response = open_file(path)
+    if isinstance(response, str):
+        protocol.send_error(sock, response)
+        return 0
+
+    set_nodelay(sock)
+    size = len(response)
+    try:
+        # more data follows the header - don't push it out on its own
+        header = protocol.pack_response_header(size)
+        sock.sendall(header, socket.MSG_MORE)
+        while len(response):
+            if not response.send(sock):
+                raise ConnectionError('Connection closed')
+    finally:
+        response.close()
+    return size
+
+
+def add_options(parser):
+    parser.add_option(
+        '--docroot', dest='docroot',
+        help='Serve files requested with FILE requests from this directory')
+
+    parser.add_option(
+        '--file-cache', dest='file_cache', type='int', default=CACHE_SIZE,
+        help=('Number of files kept open. Default is %d' % CACHE_SIZE))
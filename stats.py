@@ -0,0 +1,147 @@
+###############################################################################
+#
+# Copyright (c) 2012 Ruslan Spivak
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+###############################################################################
+
+"""
+Per-child statistics in shared memory.
+
+The slab is an anonymous memory-mapped file created by the parent before
+it forks, so all children see the same pages. Every child gets its own
+slot of 64-bit counters, one cache line long: a child only ever writes
+to its own slot and never shares a cache line with another writer, so
+the counters need no locks and children don't slow each other down.
+
+Counters are updated through a 'Q' memoryview, which reads and writes
+an aligned 8-byte word at a time. The parent can take a snapshot
+whenever it likes; every counter in it is a value the child actually
+wrote, though the counters of a slot may be a request apart.
+
+A child's slot can be followed by its own latency histogram (see
+histogram.py), laid out the way Histogram.pack_into writes it and
+updated in place the same way as the counters.
+"""
+
+__author__ = 'Ruslan Spivak <ruslan.spivak@gmail.com>'
+
+import mmap
+import collections
+
+import histogram
+
+# counters in a slot; a connection is counted in HANDLED once the
+# child is done with it, ACCEPTS - HANDLED are the ones in flight
+(ACCEPTS, WAKEUPS, EAGAINS, BYTES_SENT, ERRORS, BUSY_NS, REQUESTS,
+ HANDLED) = range(8)
+COUNTERS = ('accepts', 'wakeups', 'eagains', 'bytes_sent', 'errors',
+            'busy_ns', 'requests', 'handled')
+
+CACHE_LINE = 64
+COUNTER_SIZE = 8
+SLOT_COUNTERS = CACHE_LINE // COUNTER_SIZE
+
+assert len(COUNTERS) <= SLOT_COUNTERS
+
+Snapshot = collections.namedtuple('Snapshot', COUNTERS)
+
+
+# a histogram takes whole cache lines
+HISTOGRAM_SIZE = -(-histogram.SIZE // CACHE_LINE) * CACHE_LINE
+
+
+class Slab(object):
+    """Counters of `slot_num` children, with a latency histogram each if
+    `histograms` is true."""
+
+    def __init__(self, slot_num, histograms=False):
+        self.slot_num = slot_num
+        self.block_size = CACHE_LINE
+        if histograms:
+            self.block_size += HISTOGRAM_SIZE
+        # anonymous mapped file, it's initially filled with zero bytes,
+        # and mmap returns page-aligned memory so slots are line-aligned
+        self.map = mmap.mmap(-1, slot_num * self.block_size)
+        self.counters = memoryview(self.map).cast('Q')
+
+    def _start(self, index):
+        return index * self.block_size // COUNTER_SIZE
+
+    def slot(self, index):
+        """Returns the writer for the `index` child's slot."""
+        return Slot(self.counters, self._start(index))
+
+    def get(self, index, counter):
+        """Returns one counter of the `index` child."""
+        return self.counters[self._start(index) + counter]
+
+    def snapshot(self, index):
+        """Returns the current counters of the `index` child."""
+        start = self._start(index)
+        return Snapshot(*self.counters[start:start + len(COUNTERS)])
+
+    def snapshot_all(self):
+        """Returns the current counters of all children."""
+        return [self.snapshot(index) for index in range(self.slot_num)]
+
+    def totals(self, snapshots=None):
+        """Returns the counters of all children summed up."""
+        if snapshots is None:
+            snapshots = self.snapshot_all()
+        return Snapshot(*[sum(values) for values in zip(*snapshots)]
+                        or [0] * len(COUNTERS))
+
+    def histogram(self, index=None):
+        """Returns the latency histogram of the `index` child or of all
+        children merged."""
+        if index is not None:
+            return histogram.Histogram.unpack_from(
+                self.map, index * self.block_size + CACHE_LINE)
+        merged = histogram.Histogram()
+        for index in range(self.slot_num):
+            merged.merge(self.histogram(index))
+        return merged
+
+
+class Slot(object):
+    """The counters of one child. Only that child writes to them."""
+
+    def __init__(self, counters, start):
+        self.counters = counters
+        self.start = start
+        # the histogram's number of samples, their sum, max and buckets
+        self.histogram = start + SLOT_COUNTERS
+
+    def add(self, counter, value=1):
+        self.counters[self.start + counter] += value
+
+    def get(self, counter):
+        return self.counters[self.start + counter]
+
+    def record_latency(self, nanos):
+        """Histogram.record on the shared histogram, the slab must have
+        been created with histograms."""
+        counters, start = self.counters, self.histogram
+        counters[start + 3 + histogram.bucket(nanos)] += 1
+        counters[start] += 1
+        counters[start + 1] += nanos
+        if nanos > counters[start + 2]:
+            counters[start + 2] = nanos